@@ -0,0 +1,69 @@
+"""Reports the latency of atomic_write for every durability mode.
+
+Run with ``python benchmarks/durability.py [--files N] [--size BYTES] [--dir PATH]``.
+"Group" mode is measured with concurrent writer threads, since that is where
+coalescing fsyncs pays off.
+"""
+
+import argparse
+import os
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from csci_utils.io import DURABILITY_MODES, atomic_write
+
+
+def write_one(directory, index, payload, durability):
+    """Atomically writes one file and returns how long it took in seconds"""
+    path = os.path.join(directory, "file-%06d.bin" % index)
+    start = time.perf_counter()
+    with atomic_write(path, mode="wb", durability=durability) as f:
+        f.write(payload)
+    return time.perf_counter() - start
+
+
+def run(durability, files, size, threads, root=None):
+    """Writes ``files`` files in a fresh directory and returns their latencies"""
+    payload = os.urandom(size)
+    with tempfile.TemporaryDirectory(dir=root) as directory:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            return list(
+                pool.map(
+                    lambda i: write_one(directory, i, payload, durability), range(files)
+                )
+            )
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=200, help="files per mode")
+    parser.add_argument("--size", type=int, default=4096, help="bytes per file")
+    parser.add_argument("--threads", type=int, default=8, help="concurrent writers")
+    parser.add_argument("--dir", default=None, help="directory on the disk to test")
+    args = parser.parse_args(args=args)
+
+    print(
+        "%-10s %10s %10s %10s %12s" % ("mode", "mean ms", "p50 ms", "p99 ms", "files/s")
+    )
+    for durability in DURABILITY_MODES:
+        start = time.perf_counter()
+        latencies = sorted(
+            run(durability, args.files, args.size, args.threads, args.dir)
+        )
+        elapsed = time.perf_counter() - start
+        print(
+            "%-10s %10.3f %10.3f %10.3f %12.1f"
+            % (
+                durability,
+                1000 * statistics.mean(latencies),
+                1000 * latencies[len(latencies) // 2],
+                1000 * latencies[int(len(latencies) * 0.99) - 1],
+                args.files / elapsed,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Synthetic, reproducible inputs for the benchmark suite.
+
+Every generator is seeded so that runs on different machines or commits
+measure the same work.
+"""
+
+import os
+from typing import NamedTuple
+
+
+class Scale(NamedTuple):
+    """Size of the inputs of one benchmark run"""
+
+    rows: int  # rows of frames and number of hashed values
+    nbytes: int  # size of written and hashed files
+    excel_rows: int  # workbooks are capped, xlsx tops out at ~1M rows
+
+
+SCALES = {
+    "tiny": Scale(rows=1_000, nbytes=1 << 10, excel_rows=1_000),
+    "small": Scale(rows=100_000, nbytes=1 << 20, excel_rows=10_000),
+    "medium": Scale(rows=1_000_000, nbytes=64 << 20, excel_rows=100_000),
+    "large": Scale(rows=10_000_000, nbytes=1 << 30, excel_rows=1_000_000),
+}
+
+
+def usernames(n, distinct=50_000, seed=0):
+    """Returns n usernames drawn from ``distinct`` different ones"""
+    import numpy as np
+
+    ids = np.random.default_rng(seed).integers(0, distinct, size=n)
+    return ["user%06d" % i for i in ids]
+
+
+def frame(n, seed=0):
+    """Returns a dataframe of n rows mixing string, integer and float columns"""
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        {
+            "user": usernames(n, seed=seed),
+            "count": rng.integers(0, 1000, size=n),
+            "score": rng.random(n),
+            "group": pd.Categorical(rng.choice(["a", "b", "c", "d"], size=n)),
+        }
+    )
+
+
+def payload(nbytes, seed=0):
+    """Returns nbytes of incompressible bytes"""
+    import numpy as np
+
+    return np.random.default_rng(seed).bytes(nbytes)
+
+
+def write_file(path, nbytes, seed=0, chunk_size=64 << 20):
+    """Writes a file of nbytes random bytes without holding it all in memory"""
+    with open(path, "wb") as f:
+        written = 0
+        while written < nbytes:
+            chunk = payload(min(chunk_size, nbytes - written), seed=seed + written)
+            f.write(chunk)
+            written += len(chunk)
+    return path
+
+
+def write_parquet(path, n, seed=0):
+    """Writes a parquet file of n rows from :func:`frame`"""
+    frame(n, seed=seed).to_parquet(path)
+    return path
+
+
+def write_workbook(path, n, seed=0):
+    """Writes an xlsx workbook of n rows with an index column, as exported by users"""
+    from openpyxl import Workbook
+
+    df = frame(n, seed=seed)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(["id"] + list(df.columns))
+    for i, row in enumerate(
+        zip(df["user"], df["count"].tolist(), df["score"].tolist(), df["group"])
+    ):
+        ws.append([i] + list(row))
+    wb.save(path)
+    return path
+
+
+def scratch_dir(root=None):
+    """Returns a directory for benchmark files, on the disk under test"""
+    import tempfile
+
+    return tempfile.mkdtemp(prefix="csci-bench-", dir=root or os.environ.get("TMPDIR"))
@@ -0,0 +1,319 @@
+"""Times hashing, atomic writes and parquet I/O and compares runs.
+
+Baselines are stored in ``benchmarks/baselines/<scale>.json``. After a
+change, run the suite and compare it against the stored baseline of its
+scale::
+
+    python benchmarks/suite.py run --scale small --save results/new.json
+    python benchmarks/suite.py compare results/new.json
+
+or against another run with ``compare results/old.json results/new.json``.
+``compare`` exits with status 1 when a benchmark got slower than the baseline
+by more than ``--threshold`` (default 10%). Only compare runs of the same
+scale made on the same machine: the stored baselines record the machine they
+were made on, refresh them on yours first with::
+
+    python benchmarks/suite.py run --scale small --save benchmarks/baselines/small.json
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import time
+
+import generators
+
+# name -> setup function, see benchmark()
+BENCHMARKS = {}
+
+# stored results that compare uses when no baseline is given
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines")
+
+
+def benchmark(unit):
+    """Registers a benchmark
+
+    The decorated function gets the scale and a scratch directory, prepares
+    its inputs and returns ``(fn, amount)``: ``fn()`` is the timed work and
+    ``amount`` how many ``unit`` (rows, bytes, files) one call processes.
+    """
+
+    def register(setup):
+        BENCHMARKS[setup.__name__] = (setup, unit)
+        return setup
+
+    return register
+
+
+@benchmark("rows")
+def hash_str_loop(scale, workdir):
+    from csci_utils.hash_str import hash_str
+
+    values = generators.usernames(scale.rows)
+    return lambda: [hash_str(v, salt="bench") for v in values], scale.rows
+
+
+@benchmark("rows")
+def hash_many(scale, workdir):
+    from csci_utils.hash_str import hash_many
+
+    values = generators.usernames(scale.rows)
+    return lambda: hash_many(values, salt="bench"), scale.rows
+
+
+@benchmark("rows")
+def get_user_ids(scale, workdir):
+    from csci_utils.hash_str import get_user_ids
+
+    os.environ.setdefault("CSCI_SALT", "be4c")  # hex, as the real salt
+    values = generators.usernames(scale.rows)
+    return lambda: get_user_ids(values), scale.rows
+
+
+@benchmark("bytes")
+def hash_file(scale, workdir):
+    from csci_utils.hash_str import hash_file
+
+    path = generators.write_file(os.path.join(workdir, "hash.bin"), scale.nbytes)
+    return lambda: hash_file(path), scale.nbytes
+
+
+@benchmark("bytes")
+def atomic_write_large(scale, workdir):
+    from csci_utils.io import atomic_write
+
+    chunk = generators.payload(min(scale.nbytes, 64 << 20))
+    counter = itertools.count()
+
+    def write():
+        path = os.path.join(workdir, "large-%d.bin" % next(counter))
+        with atomic_write(path, mode="wb") as f:
+            for start in range(0, scale.nbytes, len(chunk)):
+                f.write(chunk[: scale.nbytes - start])
+        os.remove(path)
+
+    return write, scale.nbytes
+
+
+def _register_durability(durability):
+    # one benchmark per mode, with the concurrent writers of durability.py
+    def setup(scale, workdir):
+        import durability as bench
+
+        files = max(50, min(scale.rows // 100, 2000))
+        return lambda: bench.run(durability, files, 4096, 8, workdir), files
+
+    setup.__name__ = "atomic_write_%s" % durability
+    benchmark("files")(setup)
+
+
+for _durability in ("full", "dataonly", "none", "group"):
+    _register_durability(_durability)
+
+
+@benchmark("rows")
+def convert_excel_to_parquet(scale, workdir):
+    from csci_utils.io import convert_excel_to_parquet
+
+    source = generators.write_workbook(
+        os.path.join(workdir, "book.xlsx"), scale.excel_rows
+    )
+    counter = itertools.count()
+
+    def convert():
+        out = os.path.join(workdir, "book-%d.parquet" % next(counter))
+        convert_excel_to_parquet(source, parquet_file=out)
+        os.remove(out)
+
+    return convert, scale.excel_rows
+
+
+@benchmark("rows")
+def convert_excel_to_parquet_streaming(scale, workdir):
+    from csci_utils.io import convert_excel_to_parquet
+
+    source = generators.write_workbook(
+        os.path.join(workdir, "book.xlsx"), scale.excel_rows
+    )
+    counter = itertools.count()
+
+    def convert():
+        out = os.path.join(workdir, "book-%d.parquet" % next(counter))
+        convert_excel_to_parquet(source, batch_size=50_000, parquet_file=out)
+        os.remove(out)
+
+    return convert, scale.excel_rows
+
+
+@benchmark("rows")
+def read_parquet_columns(scale, workdir):
+    from csci_utils.io import read_parquet_columns
+
+    path = generators.write_parquet(os.path.join(workdir, "read.parquet"), scale.rows)
+    return lambda: read_parquet_columns(path, ["user", "score"]), scale.rows
+
+
+@benchmark("rows")
+def iter_parquet_batches(scale, workdir):
+    from csci_utils.io import iter_parquet_batches
+
+    path = generators.write_parquet(os.path.join(workdir, "scan.parquet"), scale.rows)
+    return lambda: sum(b.num_rows for b in iter_parquet_batches(path)), scale.rows
+
+
+def time_benchmark(name, scale, repeat, root=None):
+    """Runs one benchmark ``repeat`` times and returns its timings in seconds"""
+    setup, unit = BENCHMARKS[name]
+    workdir = generators.scratch_dir(root)
+    try:
+        fn, amount = setup(scale, workdir)
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    best = min(times)
+    return {
+        "min": best,
+        "median": statistics.median(times),
+        "repeat": repeat,
+        "unit": unit,
+        "amount": amount,
+        "per_second": amount / best if best else None,
+    }
+
+
+def run(args):
+    scale = generators.SCALES[args.scale]
+    names = args.only or list(BENCHMARKS)
+    unknown = sorted(set(names) - set(BENCHMARKS))
+    if unknown:
+        print("unknown benchmarks: %s" % ", ".join(unknown), file=sys.stderr)
+        return 2
+
+    results = {}
+    print("%-38s %10s %10s %16s" % ("benchmark", "min s", "median s", "per second"))
+    for name in names:
+        result = time_benchmark(name, scale, args.repeat, args.dir)
+        results[name] = result
+        print(
+            "%-38s %10.4f %10.4f %12.0f %-5s"
+            % (
+                name,
+                result["min"],
+                result["median"],
+                result["per_second"] or 0,
+                result["unit"],
+            )
+        )
+
+    if args.save:
+        report = {
+            "scale": args.scale,
+            "machine": platform.node(),
+            "python": platform.python_version(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "results": results,
+        }
+        if os.path.dirname(args.save):
+            os.makedirs(os.path.dirname(args.save), exist_ok=True)
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    return 0
+
+
+def compare_reports(baseline, current, threshold):
+    """Returns (name, baseline min, current min, ratio, slower) for shared benchmarks"""
+    rows = []
+    for name, base in sorted(baseline["results"].items()):
+        if name not in current["results"]:
+            continue
+        new = current["results"][name]["min"]
+        ratio = new / base["min"] if base["min"] else float("inf")
+        rows.append((name, base["min"], new, ratio, ratio > 1 + threshold))
+    return rows
+
+
+def compare(args):
+    with open(args.current) as f:
+        current = json.load(f)
+    if args.baseline is None:
+        args.baseline = os.path.join(BASELINE_DIR, current["scale"] + ".json")
+        if not os.path.exists(args.baseline):
+            print("no stored baseline for scale %s" % current["scale"], file=sys.stderr)
+            return 2
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline["machine"] != current["machine"]:
+        print(
+            "warning: baseline made on %s, not %s"
+            % (baseline["machine"], current["machine"]),
+            file=sys.stderr,
+        )
+    if baseline["scale"] != current["scale"]:
+        print(
+            "scales differ: %s vs %s" % (baseline["scale"], current["scale"]),
+            file=sys.stderr,
+        )
+        return 2
+
+    rows = compare_reports(baseline, current, args.threshold)
+    print("%-38s %10s %10s %8s" % ("benchmark", "base s", "new s", "ratio"))
+    for name, base, new, ratio, slower in rows:
+        flag = "  SLOWER" if slower else ""
+        print("%-38s %10.4f %10.4f %8.2f%s" % (name, base, new, ratio, flag))
+    slower = [row[0] for row in rows if row[4]]
+    print(
+        "%d benchmarks, %d slower than %.0f%% over baseline"
+        % (len(rows), len(slower), 100 * args.threshold)
+    )
+    return 1 if slower else 0
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", metavar="COMMAND")
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser("run", help="Run the benchmarks.")
+    run_parser.add_argument(
+        "--scale", choices=list(generators.SCALES), default="small", help="input size"
+    )
+    run_parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark")
+    run_parser.add_argument(
+        "--only", nargs="+", metavar="NAME", help="benchmarks to run (default: all)"
+    )
+    run_parser.add_argument("--save", help="write the results to this json file")
+    run_parser.add_argument("--dir", default=None, help="directory on the disk to test")
+
+    compare_parser = subparsers.add_parser(
+        "compare", help="Flag benchmarks slower than a baseline."
+    )
+    compare_parser.add_argument(
+        "baseline",
+        nargs="?",
+        help="results saved by run --save (default: the stored baseline)",
+    )
+    compare_parser.add_argument("current", help="results saved by run --save")
+    compare_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="allowed slowdown as a fraction (default: 0.1)",
+    )
+
+    args = parser.parse_args(args=args)
+    if args.command == "run":
+        return run(args)
+    return compare(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
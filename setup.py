@@ -63,8 +63,10 @@ setup(
         "Operating System :: POSIX",
         "Operating System :: Microsoft :: Windows",
         "Programming Language :: Python",
-        "Programming Language :: Python :: 3.6",
-        "Programming Language :: Python :: 3.7",
+        "Programming Language :: Python :: 3.8",
+        "Programming Language :: Python :: 3.9",
+        "Programming Language :: Python :: 3.10",
+        "Programming Language :: Python :: 3.11",
         "Programming Language :: Python :: Implementation :: CPython",
         "Programming Language :: Python :: Implementation :: PyPy",
         # # uncomment if you test on these interpreters:
@@ -82,21 +84,22 @@ setup(
     keywords=[
         # eg: 'keyword1', 'keyword2', 'keyword3',
     ],
-    python_requires=">=3.6",
+    python_requires=">=3.8",
     install_requires=[
         # eg: 'aspectlib==1.1.1', 'six>=1.7',
         "atomicwrites==1.3.0",
         "pandas",
         "xlrd",
-        "pyarrow",
+        "pyarrow>=14",
         "openpyxl",
-        "setuptools_scm",
         "luigi",
     ],
     extras_require={
         # eg:
         #   'rst': ['docutils>=0.11'],
         #   ':python_version=="2.6"': ['argparse'],
+        "zstd": ["zstandard"],
+        "lz4": ["lz4"],
     },
     # setup_requires=[
     #     'setuptools_scm>=3.3.1',
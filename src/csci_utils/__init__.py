@@ -1,3 +1,10 @@
-from setuptools_scm import get_version
+try:
+    # written by setuptools_scm when the package is built or installed
+    from csci_utils._version import version as __version__
+except ImportError:
+    from importlib.metadata import PackageNotFoundError, version
 
-__version__ = get_version()
+    try:
+        __version__ = version("csci-utils")
+    except PackageNotFoundError:
+        __version__ = "unknown"
@@ -14,14 +14,266 @@ Why does this file exist, and why not put this in __main__?
 
   Also see (1) from http://click.pocoo.org/5/setuptools/#setuptools-integration
 """
+
 import argparse
+import os
+import sys
+import time
+from collections import deque
+
+parser = argparse.ArgumentParser(description="Utilities for CSCI E-29 data.")
+subparsers = parser.add_subparsers(dest="command", metavar="COMMAND")
+subparsers.required = True
+
+convert_parser = subparsers.add_parser(
+    "convert", help="Convert excel workbooks to parquet files."
+)
+convert_parser.add_argument(
+    "paths",
+    metavar="PATH",
+    nargs=argparse.ONE_OR_MORE,
+    help="Workbook path or glob pattern, ** matches nested directories.",
+)
+convert_parser.add_argument(
+    "--workers", type=int, default=None, help="Number of processes (default: CPUs)."
+)
+sheet_group = convert_parser.add_mutually_exclusive_group()
+sheet_group.add_argument(
+    "--sheet", default="0", help="Position or name of the sheet (default: 0)."
+)
+sheet_group.add_argument(
+    "--all-sheets",
+    action="store_true",
+    help="Write every sheet to its own <name>-<sheet>.parquet file.",
+)
+convert_parser.add_argument(
+    "--batch-size",
+    type=int,
+    default=None,
+    help="Stream sheets in batches of this many rows.",
+)
+convert_parser.add_argument(
+    "--incremental",
+    action="store_true",
+    help="Skip sheets whose parquet file was made from the current workbook.",
+)
 
-parser = argparse.ArgumentParser(description="Command description.")
-parser.add_argument(
-    "names", metavar="NAME", nargs=argparse.ZERO_OR_MORE, help="A name of something."
+hash_parser = subparsers.add_parser(
+    "hash", help="Replace user name columns of a csv or parquet file by user ids."
+)
+hash_parser.add_argument(
+    "--column",
+    dest="columns",
+    action="append",
+    required=True,
+    help="Column to hash, may be repeated.",
+)
+hash_parser.add_argument(
+    "--in",
+    dest="input",
+    required=True,
+    help="Input .csv or .parquet file/dataset, - reads csv from stdin.",
 )
+hash_parser.add_argument(
+    "--out",
+    dest="output",
+    required=True,
+    help="Output .csv or .parquet file, - writes csv to stdout.",
+)
+hash_parser.add_argument(
+    "--overwrite", action="store_true", help="Replace the output if it exists."
+)
+hash_parser.add_argument(
+    "--workers", type=int, default=None, help="Number of processes (default: CPUs)."
+)
+hash_parser.add_argument(
+    "--chunk-size",
+    type=int,
+    default=100000,
+    help="Rows read, hashed and written at a time (default: 100000).",
+)
+
+
+def _is_parquet(path):
+    return path != "-" and (path.endswith(".parquet") or os.path.isdir(path))
+
+
+def _read_chunks(path, chunk_size):
+    """Yields dataframes of at most chunk_size rows from a csv or parquet input"""
+    if _is_parquet(path):
+        from csci_utils.io import iter_parquet_batches
+
+        # decode the next batches while the current ones are hashed
+        yield from iter_parquet_batches(
+            path, batch_size=chunk_size, as_pandas=True, readahead=2
+        )
+        return
+
+    import pandas as pd
+
+    source = sys.stdin if path == "-" else path
+    # read every field as a string so the other columns are written back as is
+    with pd.read_csv(
+        source, dtype=str, keep_default_na=False, chunksize=chunk_size
+    ) as reader:
+        yield from reader
+
+
+def _submit_columns(pool, df, columns):
+    """Starts hashing the non-missing values of columns, returns what to assign"""
+    from concurrent.futures import Future
+
+    from csci_utils.hash_str import get_user_ids
+
+    missing = [col for col in columns if col not in df.columns]
+    if missing:
+        raise ValueError("column not found: %s" % ", ".join(missing))
+
+    jobs = []
+    for col in columns:
+        # csv fields are read without NA detection, empty is missing there
+        mask = df[col].notna() & (df[col] != "")
+        values = df[col][mask].tolist()
+        if pool is None:
+            future = Future()
+            future.set_result(get_user_ids(values))
+        else:
+            future = pool.submit(get_user_ids, values)
+        jobs.append((col, mask, future))
+    return df, jobs
+
+
+def _assign_columns(df, jobs):
+    df = df.copy(deep=False)
+    for col, mask, future in jobs:
+        ids = df[col].astype(object)
+        ids[mask] = future.result()
+        df[col] = ids
+    return df
+
+
+def _hash_chunks(chunks, columns, workers):
+    """Yields the chunks with their columns hashed, in order
+
+    At most two chunks per worker are in flight, so memory stays bounded
+    however large the input is.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    if workers == 1:
+        for df in chunks:
+            yield _assign_columns(*_submit_columns(None, df, columns))
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for df in chunks:
+            pending.append(_submit_columns(pool, df, columns))
+            if len(pending) > 2 * workers:
+                yield _assign_columns(*pending.popleft())
+        while pending:
+            yield _assign_columns(*pending.popleft())
+
+
+def _write_chunks(chunks, path, overwrite=False):
+    """Writes dataframes to a csv or parquet output, returns the number of rows"""
+    from csci_utils.io import atomic_write
+
+    rows = 0
+    if _is_parquet(path):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        with atomic_write(path, mode="wb", overwrite=overwrite) as f:
+            writer = None
+            for df in chunks:
+                table = pa.Table.from_pandas(
+                    df,
+                    schema=None if writer is None else writer.schema,
+                    preserve_index=False,
+                )
+                if writer is None:
+                    writer = pq.ParquetWriter(f, table.schema)
+                writer.write_table(table)
+                rows += len(df)
+            if writer is not None:
+                writer.close()
+        return rows
+
+    def write_csv(f):
+        nonlocal rows
+        for df in chunks:
+            df.to_csv(f, index=False, header=rows == 0)
+            rows += len(df)
+
+    if path == "-":
+        write_csv(sys.stdout)
+    else:
+        with atomic_write(path, mode="w", newline="", overwrite=overwrite) as f:
+            write_csv(f)
+    return rows
+
+
+def hash_users(args):
+    """Runs the hash command and returns the exit code"""
+    if args.output != "-" and not args.overwrite and os.path.exists(args.output):
+        # fail before hashing the whole input rather than at commit
+        print(
+            "error: %s exists, pass --overwrite to replace it" % args.output,
+            file=sys.stderr,
+        )
+        return 1
+    workers = args.workers or os.cpu_count() or 1
+    start = time.perf_counter()
+    try:
+        chunks = _hash_chunks(
+            _read_chunks(args.input, args.chunk_size), args.columns, workers
+        )
+        rows = _write_chunks(chunks, args.output, overwrite=args.overwrite)
+    except (ValueError, FileExistsError) as exc:
+        print("error: %s" % exc, file=sys.stderr)
+        return 1
+    seconds = time.perf_counter() - start
+    # stdout may carry the data, report on stderr
+    print(
+        "hashed %d rows in %.2fs (%.0f rows/s)"
+        % (rows, seconds, rows / seconds if seconds else 0),
+        file=sys.stderr,
+    )
+    return 0
+
+
+def convert(args):
+    """Runs the convert command and returns the exit code"""
+    from csci_utils.io import convert_many
+
+    if args.all_sheets:
+        sheet = None
+    else:
+        sheet = int(args.sheet) if args.sheet.isdigit() else args.sheet
+
+    results = convert_many(
+        args.paths,
+        workers=args.workers,
+        sheet=sheet,
+        batch_size=args.batch_size,
+        incremental=args.incremental,
+    )
+    for result in results:
+        if result.error is None:
+            print(
+                "ok   %8.2fs  %s -> %s" % (result.seconds, result.source, result.output)
+            )
+        else:
+            print("FAIL %8.2fs  %s: %s" % (result.seconds, result.source, result.error))
+    failed = sum(result.error is not None for result in results)
+    print("%d converted, %d failed" % (len(results) - failed, failed))
+    return 1 if failed else 0
 
 
 def main(args=None):
     args = parser.parse_args(args=args)
-    print(args.names)
+    if args.command == "convert":
+        return convert(args)
+    if args.command == "hash":
+        return hash_users(args)
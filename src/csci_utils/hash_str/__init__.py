@@ -1,6 +1,12 @@
-from typing import AnyStr
+from typing import AnyStr, Iterable, NamedTuple, Optional
+from collections import OrderedDict
 from hashlib import sha256
+from time import perf_counter
 import os
+import sys
+import threading
+
+from csci_utils import instrument as _instrument
 
 
 def get_csci_salt() -> bytes:
@@ -12,6 +18,171 @@ def get_csci_salt() -> bytes:
     return bytes.fromhex(SALT)
 
 
+def _encode(x):
+    """Ensures input vars to the hash object are bytes"""
+    return x.encode() if isinstance(x, str) else x
+
+
+def _as_series(values, items):
+    """Wraps batch results into a pandas Series if that is what was given
+
+    :param values: the original batch input
+    :param items: list of results, one per input value
+    :return: a Series sharing the index of ``values``, or None for other inputs
+    """
+    # only look pandas up if it has already been imported by the caller
+    pd = sys.modules.get("pandas")
+    if pd is not None and isinstance(values, pd.Series):
+        return pd.Series(items, index=values.index, name=values.name)
+    return None
+
+
+class SaltedHasher:
+    """SHA-256 hasher with the salt already fed in
+
+    Every value is hashed on a copy of the salted state, so the salt is only
+    encoded and fed once for the lifetime of the object.
+
+    :param salt: Add randomness to the hashing
+    """
+
+    def __init__(self, salt: AnyStr = ""):
+        self.salt = _encode(salt)
+        self._base = sha256(self.salt)
+
+    def digest(self, some_val: AnyStr) -> bytes:
+        """Returns the same digest as ``hash_str(some_val, salt)``"""
+        h = self._base.copy()
+        h.update(_encode(some_val))
+        return h.digest()
+
+    def user_id(self, username: str) -> str:
+        """Returns the same id as :func:`get_user_id` would with this salt"""
+        h = self._base.copy()
+        h.update(_encode(username.lower()))
+        return h.hexdigest()[:8]
+
+
+# (CSCI_SALT hex string, hasher primed with it), rebuilt when the variable changes
+_csci_context = (None, None)
+
+
+def get_csci_hasher() -> SaltedHasher:
+    """Returns a SaltedHasher primed with the CSCI E-29 salt
+
+    The hasher is cached and only rebuilt when the CSCI_SALT environment
+    variable no longer matches the value it was built from.
+    """
+    global _csci_context
+    salt_hex = os.environ["CSCI_SALT"]
+    cached_hex, hasher = _csci_context
+    if salt_hex != cached_hex:
+        hasher = SaltedHasher(bytes.fromhex(salt_hex))
+        # swap both values in one assignment so other threads see a consistent pair
+        _csci_context = (salt_hex, hasher)
+    return hasher
+
+
+class CacheInfo(NamedTuple):
+    """Statistics of a :class:`UserIdCache`"""
+
+    hits: int
+    misses: int
+    evictions: int
+    maxsize: Optional[int]
+    currsize: int
+
+
+class UserIdCache:
+    """Thread-safe bounded memo of user ids keyed by (salt, lowercased username)
+
+    The cache is emptied as soon as it is asked for an id under a different
+    salt than the one its entries were computed with.
+
+    :param maxsize: maximum number of ids kept, None for no limit
+    :param policy: "lru" evicts the least recently used id, "fifo" the oldest one
+    """
+
+    policies = ("lru", "fifo")
+
+    def __init__(self, maxsize: Optional[int] = 4096, policy: str = "lru"):
+        if policy not in self.policies:
+            raise ValueError(
+                "policy must be one of %s (got: %s)" % (self.policies, policy)
+            )
+        self.maxsize = maxsize
+        self.policy = policy
+        self._data = OrderedDict()
+        self._salt = None
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, hasher: SaltedHasher, username: str) -> str:
+        """Returns ``hasher.user_id(username)``, computing it only on a miss"""
+        key = (hasher.salt, username.lower())
+        with self._lock:
+            if hasher.salt != self._salt:
+                # the salt changed, none of the stored ids are valid anymore
+                self._data.clear()
+                self._salt = hasher.salt
+            uid = self._data.get(key)
+            if uid is not None:
+                self.hits += 1
+                if self.policy == "lru":
+                    self._data.move_to_end(key)
+                return uid
+            self.misses += 1
+
+        # hash outside of the lock so other threads are not held up
+        uid = hasher.user_id(key[1])
+
+        with self._lock:
+            if hasher.salt == self._salt:
+                self._data[key] = uid
+                if self.maxsize is not None and len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+                    self.evictions += 1
+        return uid
+
+    def info(self) -> CacheInfo:
+        """Returns hit, miss and eviction counters along with the cache size"""
+        with self._lock:
+            return CacheInfo(
+                self.hits, self.misses, self.evictions, self.maxsize, len(self._data)
+            )
+
+    def clear(self):
+        """Empties the cache and resets its counters"""
+        with self._lock:
+            self._data.clear()
+            self._salt = None
+            self.hits = self.misses = self.evictions = 0
+
+
+# opt-in memo used by get_user_id, see enable_user_id_cache()
+_user_id_cache = None
+
+
+def enable_user_id_cache(
+    maxsize: Optional[int] = 4096, policy: str = "lru"
+) -> UserIdCache:
+    """Makes get_user_id memoize its results in a new :class:`UserIdCache`
+
+    :param maxsize: maximum number of ids kept, None for no limit
+    :param policy: "lru" or "fifo" eviction
+    :return: the cache, to inspect its statistics
+    """
+    global _user_id_cache
+    _user_id_cache = UserIdCache(maxsize=maxsize, policy=policy)
+    return _user_id_cache
+
+
+def disable_user_id_cache():
+    """Stops get_user_id from memoizing its results"""
+    global _user_id_cache
+    _user_id_cache = None
+
+
 def hash_str(some_val: AnyStr, salt: AnyStr = ""):
     """Converts strings to hash digest
 
@@ -19,29 +190,117 @@ def hash_str(some_val: AnyStr, salt: AnyStr = ""):
     :param salt: Add randomness to the hashing
     :return: hash digest of input
     """
+    # measured only while a sink listens, this is the hottest path
+    start = perf_counter() if _instrument._sinks else None
+
     # create a SHA-256 hash object
     h = sha256()
 
-    # lambda function used to ensure input vars to the hash object are bytes
-    encode = lambda x: x.encode() if isinstance(x, str) else x
-
     # feed hash object with salt bytes
-    h.update(encode(salt))
+    h.update(_encode(salt))
 
     # feed hash object with bytes representation of the input string
-    h.update(encode(some_val))
+    data = _encode(some_val)
+    h.update(data)
+
+    if start is not None:
+        _instrument.record("hash_str", perf_counter() - start, len(data))
 
     # return digest of the data fed into the hash object
     return h.digest()
 
 
+def hash_many(values: Iterable[AnyStr], salt: AnyStr = ""):
+    """Converts a batch of strings to hash digests
+
+    The salt is fed to a single :class:`SaltedHasher` up front instead of
+    being rebuilt and re-fed for each value.
+
+    :param values: iterable, numpy array or pandas Series of things to hash
+    :param salt: Add randomness to the hashing
+    :return: a pandas Series of digests if given a Series, otherwise a numpy
+        array of fixed-width ``V32`` items (``item.tobytes()`` gives the digest)
+    """
+    import numpy as np
+
+    # prime a hash object with the salt once
+    digest = SaltedHasher(salt).digest
+    with _instrument.timer("hash_many"):
+        digests = [digest(val) for val in values]
+
+    series = _as_series(values, digests)
+    if series is not None:
+        return series
+
+    # pack the digests into one contiguous buffer of 32 byte records
+    return np.frombuffer(b"".join(digests), dtype="V32")
+
+
+def hash_file(path_or_fileobj, salt: AnyStr = "", chunk_size: int = 1 << 20):
+    """Converts the contents of a file to hash digest, one chunk at a time
+
+    Chunks are read into a single reusable buffer, so memory use does not
+    grow with the size of the file.
+
+    :param path_or_fileobj: path to a file, or a binary file-like object
+    :param salt: Add randomness to the hashing, as in :func:`hash_str`
+    :param chunk_size: number of bytes read per chunk
+    :return: same digest as ``hash_str(contents, salt=salt)``
+    """
+    if isinstance(path_or_fileobj, (str, bytes, os.PathLike)):
+        # unbuffered so readinto() fills our buffer straight from the file
+        with open(path_or_fileobj, "rb", buffering=0) as f:
+            return hash_file(f, salt=salt, chunk_size=chunk_size)
+
+    h = sha256(_encode(salt))
+    f = path_or_fileobj
+    readinto = getattr(f, "readinto", None)
+    with _instrument.timer("hash_file") as timer:
+        if readinto is None:
+            # plain file-like objects only offer read()
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                h.update(chunk)
+                timer.add_bytes(len(chunk))
+            return h.digest()
+
+        buf = bytearray(chunk_size)
+        view = memoryview(buf)
+        while True:
+            n = readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+            timer.add_bytes(n)
+    return h.digest()
+
+
 def get_user_id(username: str) -> str:
     """Converts username string to hash digest
 
     :param username: string to hash
     :return: first 8 chars in hex format of hash digest of input
     """
-    # retrieve salt from environment variables
-    salt = get_csci_salt()
-    # compute and return hash digest of input
-    return hash_str(username.lower(), salt=salt).hex()[:8]
+    # compute hash digest of input with the cached salted hasher
+    hasher = get_csci_hasher()
+    cache = _user_id_cache
+    if cache is None:
+        return hasher.user_id(username)
+    return cache.get(hasher, username)
+
+
+def get_user_ids(usernames: Iterable[str]):
+    """Converts a batch of username strings to user ids
+
+    :param usernames: iterable, numpy array or pandas Series of strings to hash
+    :return: a pandas Series of ids if given a Series, otherwise a numpy array
+        of fixed-width ``U8`` strings matching :func:`get_user_id`
+    """
+    import numpy as np
+
+    user_id = get_csci_hasher().user_id
+    ids = [user_id(username) for username in usernames]
+
+    series = _as_series(usernames, ids)
+    if series is not None:
+        return series
+    return np.array(ids, dtype="U8")
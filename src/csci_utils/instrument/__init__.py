@@ -0,0 +1,204 @@
+"""Lightweight timing of the I/O and hashing hot paths
+
+Instrumented code reports events ``(name, seconds, nbytes)`` to the sinks
+registered with :func:`add_sink`. While no sink is registered, timers are a
+shared no-op object and nothing is measured, so the hooks cost almost
+nothing.
+
+Phases reported:
+
+- ``atomic_write.open``, ``.write``, ``.sync``, ``.commit``: creating the temp
+  file, the caller writing to it (with the bytes written), fsync, and the
+  rename plus directory sync
+- ``convert.parse``, ``convert.encode``: reading the workbook and encoding
+  parquet, once per batch when streaming; the commit is reported by the
+  ``atomic_write`` phases
+- ``hash_str``, ``hash_file``: one event per call with the bytes hashed
+- ``hash_many``: one event per batch
+
+To see where the time goes::
+
+    with collect() as summary:
+        convert_excel_to_parquet("data.xlsx")
+    print(summary.prometheus())
+"""
+
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Dict, NamedTuple
+import logging
+import threading
+
+# registered sinks, checked by the hot paths before measuring anything
+_sinks = []
+
+
+def add_sink(sink):
+    """Starts sending events to sink
+
+    :param sink: callable taking ``(name, seconds, nbytes)``, e.g. a
+        :class:`Summary` or :class:`LoggingSink`; it must be thread-safe
+    :return: the sink
+    """
+    _sinks.append(sink)
+    return sink
+
+
+def remove_sink(sink):
+    """Stops sending events to sink"""
+    _sinks.remove(sink)
+
+
+def record(name, seconds=0.0, nbytes=0):
+    """Sends one event to every sink"""
+    for sink in list(_sinks):
+        sink(name, seconds, nbytes)
+
+
+class _Timer:
+    __slots__ = ("name", "nbytes", "_start")
+
+    def __init__(self, name, nbytes):
+        self.name = name
+        self.nbytes = nbytes
+
+    def add_bytes(self, nbytes):
+        self.nbytes += nbytes
+
+    def __enter__(self):
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, perf_counter() - self._start, self.nbytes)
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def add_bytes(self, nbytes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def timer(name, nbytes=0):
+    """Returns a context manager reporting how long its block took
+
+    Bytes known only inside the block are added with ``t.add_bytes(n)``.
+
+    :param name: phase name
+    :param nbytes: bytes processed by the block
+    """
+    if not _sinks:
+        return _NULL_TIMER
+    return _Timer(name, nbytes)
+
+
+def timed(iterable, name):
+    """Reports the time spent producing each item of iterable as one event"""
+    if not _sinks:
+        return iterable
+    return _timed(iterable, name)
+
+
+def _timed(iterable, name):
+    iterator = iter(iterable)
+    while True:
+        start = perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        record(name, perf_counter() - start)
+        yield item
+
+
+class PhaseStats(NamedTuple):
+    """Totals of the events of one phase in a :class:`Summary`"""
+
+    count: int
+    seconds: float
+    max_seconds: float
+    nbytes: int
+
+
+class Summary:
+    """Sink keeping per-phase totals in memory"""
+
+    def __init__(self):
+        self._phases = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, name, seconds, nbytes):
+        with self._lock:
+            count, total, longest, total_bytes = self._phases.get(
+                name, (0, 0.0, 0.0, 0)
+            )
+            self._phases[name] = (
+                count + 1,
+                total + seconds,
+                max(longest, seconds),
+                total_bytes + nbytes,
+            )
+
+    def snapshot(self) -> Dict[str, PhaseStats]:
+        """Returns the totals of every phase seen so far"""
+        with self._lock:
+            return {name: PhaseStats(*stats) for name, stats in self._phases.items()}
+
+    def clear(self):
+        with self._lock:
+            self._phases.clear()
+
+    def prometheus(self, prefix="csci_utils"):
+        """Returns the totals in the Prometheus text exposition format"""
+        snapshot = sorted(self.snapshot().items())
+        metrics = [
+            ("phase_calls_total", "counter", "Number of events.", "count"),
+            ("phase_seconds_total", "counter", "Time spent in the phase.", "seconds"),
+            ("phase_seconds_max", "gauge", "Longest single event.", "max_seconds"),
+            ("phase_bytes_total", "counter", "Bytes processed.", "nbytes"),
+        ]
+        lines = []
+        for metric, kind, help_text, field in metrics:
+            metric = "%s_%s" % (prefix, metric)
+            lines.append("# HELP %s %s" % (metric, help_text))
+            lines.append("# TYPE %s %s" % (metric, kind))
+            for name, stats in snapshot:
+                lines.append(
+                    '%s{phase="%s"} %s' % (metric, name, repr(getattr(stats, field)))
+                )
+        return "\n".join(lines) + "\n"
+
+
+class LoggingSink:
+    """Sink logging every event
+
+    :param logger: defaults to the ``csci_utils.instrument`` logger
+    :param level: logging level of the events
+    """
+
+    def __init__(self, logger=None, level=logging.DEBUG):
+        self.logger = logger or logging.getLogger(__name__)
+        self.level = level
+
+    def __call__(self, name, seconds, nbytes):
+        self.logger.log(self.level, "%s took %.6fs for %d bytes", name, seconds, nbytes)
+
+
+@contextmanager
+def collect():
+    """Registers a new :class:`Summary` for the duration of the block"""
+    summary = add_sink(Summary())
+    try:
+        yield summary
+    finally:
+        remove_sink(summary)
@@ -0,0 +1,204 @@
+"""Streaming compressed formats for local targets
+
+Writers compress fixed size blocks on a pool of threads (zlib, zstd and lz4
+release the GIL) and write each block as its own gzip member or zstd/lz4
+frame, in order. Concatenated members and frames are valid files for the
+standard tools, so the output of e.g. ``Zstd`` reads back with ``zstd -d``.
+
+Use them alone for bytes, or chained behind a text format::
+
+    SuffixPreservingLocalTarget('data.csv.zst', format=UTF8 >> Zstd)
+
+``zstandard`` and ``lz4`` are optional dependencies, only needed when the
+matching format is used.
+"""
+from collections import deque
+import io
+import os
+
+from luigi.format import Format
+
+# large blocks amortize the per-member/frame overhead and the thread handoff
+DEFAULT_BUFFER_SIZE = 1 << 20
+
+
+class _BlockCompressingWriter(io.BufferedIOBase):
+    """Writable stream compressing blocks of buffer_size bytes in parallel
+
+    Closing finishes the compressed stream and closes the underlying pipe,
+    committing atomic files. Leaving a ``with`` block on an exception aborts
+    instead, so a partial output is never committed.
+    """
+
+    def __init__(self, output_pipe, compress, buffer_size, threads):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self._pipe = output_pipe
+        self._compress = compress
+        self._buffer_size = buffer_size
+        self._buffer = bytearray()
+        self._pending = deque()
+        self._threads = threads
+        self._executor = ThreadPoolExecutor(threads) if threads > 1 else None
+        self._written = False
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        if self.closed:
+            raise ValueError('write to closed file')
+        self._buffer += b
+        size = self._buffer_size
+        while len(self._buffer) >= size:
+            self._submit(bytes(self._buffer[:size]))
+            del self._buffer[:size]
+        return len(b)
+
+    def _submit(self, block):
+        self._written = True
+        if self._executor is None:
+            self._pipe.write(self._compress(block))
+            return
+        self._pending.append(self._executor.submit(self._compress, block))
+        # bound memory: keep a couple of blocks in flight per thread
+        while len(self._pending) > 2 * self._threads:
+            self._pipe.write(self._pending.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._buffer or not self._written:
+                # an empty input still gets one (empty) member/frame
+                self._submit(bytes(self._buffer))
+                self._buffer.clear()
+            while self._pending:
+                self._pipe.write(self._pending.popleft().result())
+        except BaseException:
+            self.abort()
+            raise
+        self._shutdown()
+        super(_BlockCompressingWriter, self).close()
+        self._pipe.close()
+
+    def abort(self):
+        """Drops pending blocks without closing (committing) the pipe"""
+        self._pending.clear()
+        self._buffer.clear()
+        self._shutdown()
+        super(_BlockCompressingWriter, self).close()
+
+    def _shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type:
+            self.abort()
+            return
+        self.close()
+
+
+class _DecompressingReader(io.BufferedReader):
+    """Buffered reader of a decompressing stream, closing the source pipe too"""
+
+    def __init__(self, stream, input_pipe, buffer_size):
+        super(_DecompressingReader, self).__init__(stream, buffer_size)
+        self._pipe = input_pipe
+
+    def close(self):
+        try:
+            super(_DecompressingReader, self).close()
+        finally:
+            self._pipe.close()
+
+
+class _BlockCompressedFormat(Format):
+    """Base of the compressed formats
+
+    :param level: compression level, None for the library default
+    :param threads: threads compressing blocks, None for one per CPU
+    :param buffer_size: size of the compressed blocks and read buffers
+    """
+
+    input = 'bytes'
+    output = 'bytes'
+
+    def __init__(self, level=None, threads=None, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.level = level
+        self.threads = threads if threads is not None else (os.cpu_count() or 1)
+        self.buffer_size = buffer_size
+
+    def compressor(self):
+        """Returns a thread-safe function compressing one block"""
+        raise NotImplementedError()
+
+    def decompressing_stream(self, input_pipe):
+        """Returns a readable stream of the decompressed input_pipe"""
+        raise NotImplementedError()
+
+    def pipe_reader(self, input_pipe):
+        return _DecompressingReader(
+            self.decompressing_stream(input_pipe), input_pipe, self.buffer_size
+        )
+
+    def pipe_writer(self, output_pipe):
+        return _BlockCompressingWriter(
+            output_pipe, self.compressor(), self.buffer_size, self.threads
+        )
+
+
+class GzipFormat(_BlockCompressedFormat):
+    """Multi-member gzip, unlike ``luigi.format.Gzip`` no gzip process is spawned"""
+
+    def compressor(self):
+        import gzip
+
+        level = 6 if self.level is None else self.level
+        # mtime=0 makes the output reproducible for the same contents
+        return lambda block: gzip.compress(block, compresslevel=level, mtime=0)
+
+    def decompressing_stream(self, input_pipe):
+        import gzip
+
+        return gzip.GzipFile(fileobj=input_pipe, mode='rb')
+
+
+class ZstdFormat(_BlockCompressedFormat):
+    """Zstandard frames, requires the ``zstandard`` package"""
+
+    def compressor(self):
+        import zstandard
+
+        level = 3 if self.level is None else self.level
+        # compressor contexts are not thread-safe, use one per block
+        return lambda block: zstandard.ZstdCompressor(level=level).compress(block)
+
+    def decompressing_stream(self, input_pipe):
+        import zstandard
+
+        return zstandard.ZstdDecompressor().stream_reader(
+            input_pipe, read_size=self.buffer_size, read_across_frames=True
+        )
+
+
+class Lz4Format(_BlockCompressedFormat):
+    """LZ4 frames, requires the ``lz4`` package"""
+
+    def compressor(self):
+        import lz4.frame
+
+        level = 0 if self.level is None else self.level
+        return lambda block: lz4.frame.compress(block, compression_level=level)
+
+    def decompressing_stream(self, input_pipe):
+        import lz4.frame
+
+        return lz4.frame.LZ4FrameFile(input_pipe, mode='rb')
+
+
+Gzip = GzipFormat()
+Zstd = ZstdFormat()
+Lz4 = Lz4Format()
@@ -2,18 +2,150 @@ from luigi.local_target import LocalTarget, atomic_file
 from contextlib import contextmanager
 import random
 import io
+import json
+import os
+import threading
+import time
+from collections import defaultdict
 from luigi.format import FileWrapper
 
+from csci_utils.hash_str import hash_file, hash_str
+from csci_utils.io import atomic_write
 
-class suffix_preserving_atomic_file(atomic_file):
+
+class ExistenceCache(object):
+    """Thread-safe memo of whether paths exist, trusted for ``ttl`` seconds
+
+    Entries older than the ttl are checked again on disk, so files written or
+    removed by other processes are noticed after at most ``ttl`` seconds.
+    Commits, moves, copies and removals done through the targets of this
+    module update the cache immediately.
+    """
+
+    def __init__(self, ttl=5.0):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """Returns True/False if known and fresh, None if it must be checked"""
+        with self._lock:
+            entry = self._entries.get(path)
+        if entry is None or entry[1] <= time.monotonic():
+            return None
+        return entry[0]
+
+    def set(self, path, exists):
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            self._entries[path] = (exists, expires)
+
+    def update(self, results):
+        """Records a mapping of path to existence at once"""
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            for path, exists in results.items():
+                self._entries[path] = (exists, expires)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# opt-in cache used by the targets of this module, see enable_existence_cache()
+_existence_cache = None
+
+
+def enable_existence_cache(ttl=5.0):
+    """Makes targets of this module memoize ``exists()`` for ttl seconds
+
+    :param ttl: seconds a result is trusted before checking the disk again
+    :return: the cache
+    """
+    global _existence_cache
+    _existence_cache = ExistenceCache(ttl=ttl)
+    return _existence_cache
+
+
+def disable_existence_cache():
+    """Stops targets of this module from memoizing ``exists()``"""
+    global _existence_cache
+    _existence_cache = None
+
+
+def _record_existence(path, exists):
+    cache = _existence_cache
+    if cache is not None:
+        cache.set(os.path.abspath(path), exists)
+
+
+def _scan_directory(directory, names):
+    """Returns which of names exist in directory, following symlinks"""
+    try:
+        with os.scandir(directory) as entries:
+            # only the wanted entries are checked, is_file() may stat symlinks;
+            # broken symlinks are neither, matching os.path.exists
+            return {
+                entry.name for entry in entries
+                if entry.name in names and (entry.is_file() or entry.is_dir())
+            }
+    except (FileNotFoundError, NotADirectoryError):
+        return set()
+
+
+def exists_many(targets):
+    """Checks the existence of many local targets with one scan per directory
+
+    Unlike calling ``exists()`` on each target, which stats every path, the
+    paths are grouped by directory and each directory is listed once. Fresh
+    results of the existence cache are used when it is enabled, and the
+    results of the scan are stored back into it.
+
+    :param targets: local targets or paths
+    :return: list of booleans, in the order of targets
+    """
+    cache = _existence_cache
+    paths = [os.path.abspath(getattr(target, 'path', target)) for target in targets]
+    results = {}
+    by_directory = defaultdict(list)
+    for path in paths:
+        known = cache.get(path) if cache is not None else None
+        if known is None:
+            by_directory[os.path.dirname(path)].append(path)
+        else:
+            results[path] = known
+
+    scanned = {}
+    for directory, dir_paths in by_directory.items():
+        names = _scan_directory(directory, {os.path.basename(path) for path in dir_paths})
+        for path in dir_paths:
+            scanned[path] = os.path.basename(path) in names
+    if cache is not None:
+        cache.update(scanned)
+    results.update(scanned)
+    return [results[path] for path in paths]
+
+
+class recorded_atomic_file(atomic_file):
+    """atomic_file that updates the existence cache when it commits"""
+
+    def move_to_final_destination(self):
+        super(recorded_atomic_file, self).move_to_final_destination()
+        _record_existence(self.path, True)
+
+
+class suffix_preserving_atomic_file(recorded_atomic_file):
     def generate_tmp_path(self, path):
-        file_extension = '.'.join(path.split('/')[-1].split('.')[1:])
-        return '.'.join(path.split('.')[:-1]) + '-luigi-tmp-%09d' % random.randrange(0, 1e10) + file_extension
+        # keep every suffix of the name, e.g. data.csv.zst -> data-luigi-tmp-N.csv.zst
+        head, tail = os.path.split(path)
+        stem, dot, file_extension = tail.partition('.')
+        return os.path.join(head, stem + '-luigi-tmp-%09d' % random.randrange(0, 10 ** 10) + dot + file_extension)
 
 
 class BaseAtomicProviderLocalTarget(LocalTarget):
-    # Allow some composability of atomic handling
-    atomic_provider = atomic_file
+    # Allow some composability of atomic handling; providers other than
+    # recorded_atomic_file subclasses should call _record_existence on commit
+    atomic_provider = recorded_atomic_file
 
     def open(self, mode='r'):
         # leverage super() as well as modifying any code in LocalTarget
@@ -21,11 +153,11 @@ class BaseAtomicProviderLocalTarget(LocalTarget):
         rwmode = mode.replace('b', '').replace('t', '')
         if rwmode == 'w':
             self.makedirs()
-            return super(LocalTarget,self).format.pipe_writer(self.atomic_provider(self.path))
+            return self.format.pipe_writer(self.atomic_provider(self.path))
     
         elif rwmode == 'r':
             fileobj = FileWrapper(io.BufferedReader(io.FileIO(self.path, mode)))
-            return super(LocalTarget,self).format.pipe_reader(fileobj)
+            return self.format.pipe_reader(fileobj)
 
         else:
             raise Exception("mode must be 'r' or 'w' (got: %s)" % mode)
@@ -38,6 +170,140 @@ class BaseAtomicProviderLocalTarget(LocalTarget):
         with self.atomic_provider(self.path) as af:
             yield af.tmp_path
 
+    def exists(self):
+        cache = _existence_cache
+        if cache is None:
+            return super(BaseAtomicProviderLocalTarget, self).exists()
+        path = os.path.abspath(self.path)
+        exists = cache.get(path)
+        if exists is None:
+            exists = super(BaseAtomicProviderLocalTarget, self).exists()
+            cache.set(path, exists)
+        return exists
+
+    def remove(self):
+        super(BaseAtomicProviderLocalTarget, self).remove()
+        _record_existence(self.path, False)
+
+    def move(self, new_path, raise_if_exists=False):
+        super(BaseAtomicProviderLocalTarget, self).move(new_path, raise_if_exists=raise_if_exists)
+        _record_existence(self.path, False)
+        _record_existence(new_path, True)
+
+    def copy(self, new_path, raise_if_exists=False):
+        super(BaseAtomicProviderLocalTarget, self).copy(new_path, raise_if_exists=raise_if_exists)
+        _record_existence(self.path, True)
+        _record_existence(new_path, True)
+
 
 class SuffixPreservingLocalTarget(BaseAtomicProviderLocalTarget):
     atomic_provider = suffix_preserving_atomic_file
+
+
+def combined_digest(targets):
+    """Returns one digest standing for the contents of all the given targets
+
+    :param targets: DigestLocalTargets, e.g. ``luigi.task.flatten(task.input())``;
+        their order matters
+    :return: hex digest, or None if any target has no known digest
+    """
+    digests = [target.digest() for target in targets]
+    if any(digest is None for digest in digests):
+        return None
+    # pair each digest with its position, swapping the contents of two inputs
+    # must change the result while moving the inputs elsewhere must not
+    return hash_str('\n'.join(
+        '%d %s' % (position, digest) for position, digest in enumerate(digests)
+    )).hex()
+
+
+class digest_atomic_file(suffix_preserving_atomic_file):
+    """Suffix preserving atomic file that records a digest of what it commits
+
+    The SHA-256 of the contents is computed by streaming the temp file and
+    stored, with the size and mtime it belongs to, in a hidden sidecar file
+    written after the move so a crash never leaves a stale digest behind.
+    """
+
+    def __init__(self, path, inputs_digest=None, salt=''):
+        self.inputs_digest = inputs_digest
+        self.salt = salt
+        super(digest_atomic_file, self).__init__(path)
+
+    def move_to_final_destination(self):
+        digest = hash_file(self.tmp_path, salt=self.salt).hex()
+        super(digest_atomic_file, self).move_to_final_destination()
+        st = os.stat(self.path)
+        record = {
+            'sha256': digest,
+            'size': st.st_size,
+            'mtime_ns': st.st_mtime_ns,
+            'inputs': self.inputs_digest,
+        }
+        with atomic_write(digest_path(self.path), overwrite=True) as f:
+            json.dump(record, f)
+
+
+def digest_path(path):
+    """Returns the hidden sidecar file holding the digest record of path"""
+    head, tail = os.path.split(path)
+    return os.path.join(head, '.%s.sha256' % tail)
+
+
+class DigestLocalTarget(SuffixPreservingLocalTarget):
+    """Suffix preserving target that knows the digest of its contents
+
+    :param inputs: targets this output is computed from; their combined
+        digest is recorded on commit so ``is_current()`` can tell whether the
+        output was built from the same input bytes
+    :param salt: salt of the recorded digest, as in ``hash_str``
+    """
+
+    def __init__(self, path=None, format=None, is_tmp=False, inputs=(), salt=''):
+        super(DigestLocalTarget, self).__init__(path, format=format, is_tmp=is_tmp)
+        self.inputs = list(inputs)
+        self.salt = salt
+
+    def atomic_provider(self, path):
+        # computed at commit time, the inputs may have been rebuilt meanwhile
+        inputs_digest = combined_digest(self.inputs) if self.inputs else None
+        return digest_atomic_file(path, inputs_digest=inputs_digest, salt=self.salt)
+
+    def _record(self):
+        """Returns the sidecar record if it still describes the file"""
+        try:
+            with open(digest_path(self.path)) as f:
+                record = json.load(f)
+            st = os.stat(self.path)
+        except (OSError, ValueError):
+            return None
+        if (record.get('size'), record.get('mtime_ns')) != (st.st_size, st.st_mtime_ns):
+            return None
+        return record
+
+    def digest(self):
+        """Returns the hex SHA-256 of the contents, None if the file is missing
+
+        The recorded digest is used while the file is unchanged since its
+        commit, otherwise the file is hashed again.
+        """
+        record = self._record()
+        if record is not None:
+            return record['sha256']
+        if not self.exists():
+            return None
+        return hash_file(self.path, salt=self.salt).hex()
+
+    def is_current(self):
+        """Tells whether the output exists and was built from the current inputs"""
+        record = self._record()
+        if record is None:
+            return False
+        if not self.inputs:
+            return True
+        return record.get('inputs') == combined_digest(self.inputs)
+
+    def remove(self):
+        super(DigestLocalTarget, self).remove()
+        if os.path.exists(digest_path(self.path)):
+            os.remove(digest_path(self.path))
@@ -3,15 +3,41 @@
 
 """Tests for `csci_utils` package."""
 
+import asyncio
+import gzip
+import importlib.util
+import io
 import os
+import subprocess
+import sys
+import threading
+import time
 import pandas as pd
 from tempfile import TemporaryDirectory
-from unittest import TestCase
+from unittest import TestCase, skipUnless
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 
 from csci_utils.hash_str import hash_str, get_csci_salt, get_user_id
+from csci_utils.hash_str import hash_many, get_user_ids
+from csci_utils.hash_str import SaltedHasher, get_csci_hasher, hash_file
+from csci_utils.hash_str import UserIdCache, enable_user_id_cache, disable_user_id_cache
 from csci_utils.io import atomic_write
 from csci_utils.io import get_user_hash, convert_excel_to_parquet, read_parquet_columns
+from csci_utils.io import pseudonymize_frame, read_parquet, ParquetReaderCache
+from csci_utils.io import iter_parquet_batches, _readahead, write_parquet_dataset
+from csci_utils.io import build_parquet_index, ParquetIndex
+from csci_utils.io import AtomicBatch, atomic_write_many, DURABILITY_MODES
+from csci_utils.io import GroupCommitter
+from csci_utils.io import atomic_write_async, convert_many
+from csci_utils.cli import main as cli_main
+from csci_utils import instrument
+from csci_utils.luigi.target import DigestLocalTarget, SuffixPreservingLocalTarget
+from csci_utils.luigi.target import BaseAtomicProviderLocalTarget
+from csci_utils.luigi.target import exists_many, enable_existence_cache
+from csci_utils.luigi.target import disable_existence_cache
+from csci_utils.luigi.target import suffix_preserving_atomic_file
+from csci_utils.luigi.format import GzipFormat, ZstdFormat, Lz4Format
 
 
 @contextmanager
@@ -26,6 +52,12 @@ def set_env(**kwargs):
         os.environ.update(_environ)
 
 
+def _write_group(path):
+    """writes a file in group mode, run in a forked child process"""
+    with atomic_write(path, durability="group") as f:
+        f.write("child")
+
+
 class FakeFileFailure(IOError):
     """Class used to define a fake file failure that can be raised to mimic a real error"""
 
@@ -97,6 +129,151 @@ class HashTests(TestCase):
             self.assertEqual(get_user_id("johndoe".upper()), "7d324c87")
 
 
+class BatchHashTests(TestCase):
+    def test_hash_many_matches_hash_str(self):
+        """ensure batch digests match the scalar function byte for byte"""
+        values = ["world!", "", "hello", b"bytes too"]
+        digests = hash_many(values, salt="hello, ")
+        self.assertEqual(digests.dtype.itemsize, 32)
+        for val, digest in zip(values, digests):
+            self.assertEqual(digest.tobytes(), hash_str(val, salt="hello, "))
+
+    def test_hash_many_series(self):
+        """ensure a Series input returns a Series with the same index"""
+        series = pd.Series(["a", "b"], index=[10, 20], name="user")
+        digests = hash_many(series, salt="s")
+        self.assertIsInstance(digests, pd.Series)
+        self.assertEqual(list(digests.index), [10, 20])
+        self.assertEqual(digests[20], hash_str("b", salt="s"))
+
+    def test_get_user_ids(self):
+        """ensure batch user ids match get_user_id for arrays and Series"""
+        salt_hex = "my salt".encode().hex()
+        names = ["johndoe", "JohnDoe", "janedoe"]
+        with set_env(CSCI_SALT=salt_hex):
+            expected = [get_user_id(name) for name in names]
+            self.assertEqual(list(get_user_ids(iter(names))), expected)
+            self.assertEqual(list(get_user_ids(pd.Series(names))), expected)
+            self.assertEqual(get_user_ids(names).dtype.kind, "U")
+
+
+class PseudonymizeTests(TestCase):
+    def setUp(self):
+        self.df = pd.DataFrame(
+            {
+                "user": ["alice", "bob", "carol"],
+                "email": ["a@x", "b@x", "c@x"],
+                "n": [1, 2, 3],
+            }
+        )
+
+    def expected(self, salt):
+        out = self.df.copy()
+        for col in ["user", "email"]:
+            out[col] = out[col].map(lambda u: get_user_hash(u, salt=salt))
+        return out
+
+    def test_serial_matches_get_user_hash(self):
+        """ensure hashed columns match mapping get_user_hash over them"""
+        result = pseudonymize_frame(self.df, ["user", "email"], salt="s", workers=1)
+        self.assertTrue(result.equals(self.expected("s")))
+        # the input frame must be left untouched
+        self.assertEqual(self.df["user"][0], "alice")
+
+    def test_pool_matches_serial(self):
+        """ensure the process pool gives exactly the serial output"""
+        with set_env(CSCI_SALT="my salt".encode().hex()):
+            serial = pseudonymize_frame(self.df, "user", workers=1)
+            pooled = pseudonymize_frame(self.df, "user", workers=2, chunk_size=1)
+        self.assertTrue(serial.equals(pooled))
+        self.assertTrue(pooled["email"].equals(self.df["email"]))
+
+
+class SaltedHasherTests(TestCase):
+    def test_matches_scalar_functions(self):
+        """ensure the hasher gives the same results as hash_str and get_user_id"""
+        hasher = SaltedHasher("hello, ")
+        self.assertEqual(hasher.digest("world!"), hash_str("world!", salt="hello, "))
+        # the primed state must not be consumed by earlier calls
+        self.assertEqual(hasher.digest("world!"), hash_str("world!", salt="hello, "))
+        with set_env(CSCI_SALT="my salt".encode().hex()):
+            self.assertEqual(SaltedHasher(b"my salt").user_id("JohnDoe"), "7d324c87")
+
+    def test_csci_hasher_follows_env(self):
+        """ensure the cached hasher is reused and rebuilt when CSCI_SALT changes"""
+        with set_env(CSCI_SALT="my salt".encode().hex()):
+            hasher = get_csci_hasher()
+            self.assertIs(get_csci_hasher(), hasher)
+            self.assertEqual(get_user_id("johndoe"), "7d324c87")
+        with set_env(CSCI_SALT="other salt".encode().hex()):
+            self.assertIsNot(get_csci_hasher(), hasher)
+            self.assertEqual(get_csci_hasher().salt, b"other salt")
+            self.assertNotEqual(get_user_id("johndoe"), "7d324c87")
+
+
+class UserIdCacheTests(TestCase):
+    def tearDown(self):
+        disable_user_id_cache()
+
+    def test_hits_and_misses(self):
+        """ensure cached ids are correct and counted regardless of letter case"""
+        cache = enable_user_id_cache(maxsize=8)
+        with set_env(CSCI_SALT="my salt".encode().hex()):
+            self.assertEqual(get_user_id("johndoe"), "7d324c87")
+            self.assertEqual(get_user_id("JohnDoe"), "7d324c87")
+        info = cache.info()
+        self.assertEqual((info.hits, info.misses, info.currsize), (1, 1, 1))
+
+    def test_eviction_policies(self):
+        """ensure lru keeps recently used ids while fifo evicts the oldest"""
+        hasher = SaltedHasher("s")
+        for policy, survivor in [("lru", "a"), ("fifo", "b")]:
+            cache = UserIdCache(maxsize=2, policy=policy)
+            for name in ["a", "b", "a", "c"]:
+                self.assertEqual(cache.get(hasher, name), hasher.user_id(name))
+            self.assertEqual(cache.info().evictions, 1)
+            cache.get(hasher, survivor)
+            self.assertEqual(cache.info().hits, 2)
+        self.assertRaises(ValueError, UserIdCache, policy="random")
+
+    def test_cleared_on_salt_change(self):
+        """ensure ids computed under an old salt are never returned"""
+        cache = enable_user_id_cache()
+        with set_env(CSCI_SALT="my salt".encode().hex()):
+            get_user_id("johndoe")
+        with set_env(CSCI_SALT="other salt".encode().hex()):
+            self.assertNotEqual(get_user_id("johndoe"), "7d324c87")
+        self.assertEqual(cache.info().hits, 0)
+        self.assertEqual(cache.info().currsize, 1)
+
+
+class HashFileTests(TestCase):
+    def test_matches_hash_str(self):
+        """ensure chunked file hashing matches hashing the whole content"""
+        data = os.urandom(10000)
+        with TemporaryDirectory() as tmp:
+            fp = os.path.join(tmp, "data.bin")
+            with open(fp, "wb") as f:
+                f.write(data)
+            expected = hash_str(data, salt="salty")
+            self.assertEqual(hash_file(fp, salt="salty", chunk_size=999), expected)
+            with open(fp, "rb") as f:
+                self.assertEqual(hash_file(f, salt=b"salty", chunk_size=4096), expected)
+
+    def test_empty_and_read_only_fileobj(self):
+        """ensure empty files and objects without readinto are supported"""
+
+        class Reader:
+            def __init__(self, data):
+                self.stream = io.BytesIO(data)
+
+            def read(self, size):
+                return self.stream.read(size)
+
+        self.assertEqual(hash_file(io.BytesIO(b"")), hash_str(""))
+        self.assertEqual(hash_file(Reader(b"abc"), chunk_size=2), hash_str("abc"))
+
+
 class SaltTests(TestCase):
     def test_csci_salt(self):
         """ensure SALT environment variable is properly retrieved"""
@@ -175,6 +352,279 @@ class AtomicWriteTests(TestCase):
                 self.assertIsInstance(f, str)
 
 
+class TempFileTests(TestCase):
+    def test_preallocated_size(self):
+        """ensure preallocation never changes what is committed"""
+        with TemporaryDirectory() as tmp:
+            fp = os.path.join(tmp, "data.bin")
+            with atomic_write(fp, "wb", expected_size=1 << 16) as f:
+                self.assertTrue(f.name.endswith(".bin"))
+                f.write(b"x" * 100)
+            self.assertEqual(os.path.getsize(fp), 100)
+            # text files are truncated to the bytes written as well
+            fp = os.path.join(tmp, "data.txt")
+            with atomic_write(fp, expected_size=1 << 16) as f:
+                f.write("asdf")
+            with open(fp) as f:
+                self.assertEqual(f.read(), "asdf")
+            # writes through the path, with the descriptor still at 0
+            fp = os.path.join(tmp, "path.bin")
+            with atomic_write(fp, "wb", as_file=False, expected_size=4096) as name:
+                with open(name, "wb") as f:
+                    f.write(b"x" * 1000)
+            self.assertEqual(os.path.getsize(fp), 1000)
+            # and a header rewritten after the body
+            fp = os.path.join(tmp, "header.bin")
+            with atomic_write(fp, "wb", expected_size=4096) as f:
+                f.write(b"x" * 1000)
+                f.seek(0)
+                f.write(b"hdr")
+            with open(fp, "rb") as f:
+                self.assertEqual(f.read(), b"hdr" + b"x" * 997)
+
+    def test_anonymous(self):
+        """ensure unnamed temp files are linked in, or left out on failure"""
+        with TemporaryDirectory() as tmp:
+            fp = os.path.join(tmp, "asdf.txt")
+            with atomic_write(fp, anonymous=True) as f:
+                f.write("asdf")
+                self.assertEqual(
+                    os.listdir(tmp),
+                    [] if "/proc/" in f.name else [os.path.basename(f.name)],
+                )
+            with open(fp) as f:
+                self.assertEqual(f.read(), "asdf")
+
+            with atomic_write(fp, anonymous=True, overwrite=True) as f:
+                f.write("qwer")
+            with open(fp) as f:
+                self.assertEqual(f.read(), "qwer")
+
+            with self.assertRaises(FakeFileFailure):
+                with atomic_write(os.path.join(tmp, "b.txt"), anonymous=True) as f:
+                    f.write("asdf")
+                    raise FakeFileFailure()
+            self.assertEqual(os.listdir(tmp), ["asdf.txt"])
+
+
+class MmapWriteTests(TestCase):
+    def test_mmap_write(self):
+        """ensure bytes written through the memory map are committed"""
+        with TemporaryDirectory() as tmp:
+            fp = os.path.join(tmp, "array.npy")
+            data = os.urandom(5000)
+            with atomic_write(fp, mode="mmap", size=len(data)) as m:
+                self.assertFalse(os.path.exists(fp))
+                view = memoryview(m)
+                view[:] = data
+                view.release()
+            with open(fp, "rb") as f:
+                self.assertEqual(f.read(), data)
+            self.assertEqual(os.listdir(tmp), ["array.npy"])
+
+    def test_mmap_failure(self):
+        """ensure a failed or unsized mmap write leaves nothing behind"""
+        with TemporaryDirectory() as tmp:
+            fp = os.path.join(tmp, "array.bin")
+            with self.assertRaises(FakeFileFailure):
+                with atomic_write(fp, mode="mmap", size=10) as m:
+                    m[:4] = b"asdf"
+                    raise FakeFileFailure()
+            with self.assertRaises(ValueError):
+                with atomic_write(fp, mode="mmap"):
+                    pass
+            self.assertEqual(os.listdir(tmp), [])
+
+
+class DurabilityTests(TestCase):
+    def test_all_modes_commit(self):
+        """ensure every durability mode writes the expected content"""
+        with TemporaryDirectory() as tmp:
+            for durability in DURABILITY_MODES:
+                fp = os.path.join(tmp, durability + ".bin")
+                with atomic_write(fp, "wb", durability=durability) as f:
+                    f.write(b"asdf")
+                with open(fp, "rb") as f:
+                    self.assertEqual(f.read(), b"asdf")
+
+    def test_group_concurrent_writers(self):
+        """ensure concurrent writers in group mode all get committed"""
+        with TemporaryDirectory() as tmp:
+
+            def write(i):
+                with atomic_write(
+                    os.path.join(tmp, "%d.txt" % i), durability="group"
+                ) as f:
+                    f.write(str(i))
+
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                list(pool.map(write, range(20)))
+            self.assertEqual(len(os.listdir(tmp)), 20)
+
+    def test_group_shares_one_sync(self):
+        """ensure waiting writers are covered by the sync of the first one"""
+        committer = GroupCommitter(window=30, max_batch=4)
+        with TemporaryDirectory() as tmp:
+
+            def sync():
+                fd = os.open(tmp, os.O_RDONLY)
+                try:
+                    committer.sync(fd)
+                finally:
+                    os.close(fd)
+
+            start = time.monotonic()
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                list(pool.map(lambda _: sync(), range(4)))
+            # a writer syncing alone would have waited out the whole window
+            self.assertLess(time.monotonic() - start, 10)
+            self.assertEqual(committer._files, {})
+
+    def test_group_after_fork(self):
+        """ensure a forked child can use group mode after its parent did"""
+        import multiprocessing
+
+        with TemporaryDirectory() as tmp:
+            with atomic_write(os.path.join(tmp, "parent.txt"), durability="group") as f:
+                f.write("parent")
+            child = multiprocessing.get_context("fork").Process(
+                target=_write_group, args=(os.path.join(tmp, "child.txt"),)
+            )
+            child.start()
+            child.join(10)
+            if child.is_alive():
+                child.kill()
+                self.fail("group commit hung in the forked child")
+            self.assertEqual(child.exitcode, 0)
+            self.assertTrue(os.path.exists(os.path.join(tmp, "child.txt")))
+
+    def test_invalid_mode(self):
+        """ensure unknown durability modes are rejected"""
+        with TemporaryDirectory() as tmp:
+            with self.assertRaises(ValueError):
+                with atomic_write(os.path.join(tmp, "a.txt"), durability="maybe"):
+                    pass
+            self.assertEqual(os.listdir(tmp), [])
+
+
+class AtomicWriteAsyncTests(TestCase):
+    def test_write(self):
+        """ensure the async writer commits a suffix preserving temp file"""
+        with TemporaryDirectory() as tmp:
+            fp = os.path.join(tmp, "asdf.txt")
+
+            async def write():
+                async with atomic_write_async(fp) as f:
+                    self.assertTrue(f.name.endswith(".txt"))
+                    await f.write("asdf")
+                    self.assertFalse(os.path.exists(fp))
+                return f.name
+
+            tmpfile = asyncio.run(write())
+            self.assertFalse(os.path.exists(tmpfile))
+            with open(fp) as f:
+                self.assertEqual(f.read(), "asdf")
+
+    def test_cancel_rolls_back(self):
+        """ensure cancelling the writing task leaves no file behind"""
+        with TemporaryDirectory() as tmp:
+            fp = os.path.join(tmp, "asdf.bin")
+
+            async def write(started):
+                async with atomic_write_async(fp, "wb", as_file=False) as name:
+                    started.set_result(name)
+                    await asyncio.sleep(10)
+
+            async def cancel():
+                started = asyncio.get_running_loop().create_future()
+                task = asyncio.ensure_future(write(started))
+                tmpfile = await started
+                self.assertTrue(os.path.exists(tmpfile))
+                task.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+
+            asyncio.run(cancel())
+            self.assertEqual(os.listdir(tmp), [])
+
+    def test_cancel_while_creating(self):
+        """ensure a temp file created after the task was cancelled is removed"""
+        started, release = threading.Event(), threading.Event()
+
+        class SlowExecutor(ThreadPoolExecutor):
+            # the first call, creating the temp file, waits to be released
+            def submit(self, fn, *args, **kwargs):
+                def slow():
+                    started.set()
+                    release.wait()
+                    return fn(*args, **kwargs)
+
+                return super().submit(slow if not started.is_set() else fn)
+
+        with TemporaryDirectory() as tmp:
+            fp = os.path.join(tmp, "asdf.bin")
+            executor = SlowExecutor(1)
+
+            async def write():
+                async with atomic_write_async(fp, "wb", executor=executor) as f:
+                    await f.write(b"asdf")
+
+            async def cancel():
+                task = asyncio.ensure_future(write())
+                while not started.is_set():
+                    await asyncio.sleep(0.01)
+                task.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+
+            asyncio.run(cancel())
+            release.set()
+            executor.shutdown(wait=True)
+            self.assertEqual(os.listdir(tmp), [])
+
+
+class AtomicBatchTests(TestCase):
+    def test_commit_all(self):
+        """ensure every file of the batch appears only once the batch exits"""
+        with TemporaryDirectory() as tmp:
+            paths = [os.path.join(tmp, name) for name in ["a.txt", "b.csv"]]
+            with atomic_write_many(paths) as files:
+                for f, fp, text in zip(files, paths, ["a", "b"]):
+                    # temp files keep the suffix of their destination
+                    self.assertTrue(f.name.endswith(os.path.splitext(fp)[1]))
+                    f.write(text)
+                self.assertFalse(any(os.path.exists(fp) for fp in paths))
+            for fp, text in zip(paths, ["a", "b"]):
+                with open(fp) as f:
+                    self.assertEqual(f.read(), text)
+            self.assertEqual(sorted(os.listdir(tmp)), ["a.txt", "b.csv"])
+
+    def test_rollback_all(self):
+        """ensure a failure leaves neither temp nor destination files behind"""
+        with TemporaryDirectory() as tmp:
+            with self.assertRaises(FakeFileFailure):
+                with AtomicBatch() as batch:
+                    batch.open(os.path.join(tmp, "a.txt")).write("a")
+                    batch.open(os.path.join(tmp, "b.bin"), "wb").write(b"b")
+                    raise FakeFileFailure()
+            self.assertEqual(os.listdir(tmp), [])
+
+    def test_existing_destination(self):
+        """ensure an existing destination aborts the whole batch"""
+        with TemporaryDirectory() as tmp:
+            existing = os.path.join(tmp, "b.txt")
+            with open(existing, "w") as f:
+                f.write("old")
+            paths = [os.path.join(tmp, "a.txt"), existing]
+            with self.assertRaises(FileExistsError):
+                with atomic_write_many(paths) as files:
+                    for f in files:
+                        f.write("new")
+            self.assertEqual(os.listdir(tmp), ["b.txt"])
+            with open(existing) as f:
+                self.assertEqual(f.read(), "old")
+
+
 class ParquetTests(TestCase):
     def test_read_cols(self):
         """ensure only requested cols are read and returned"""
@@ -203,6 +653,106 @@ class ParquetTests(TestCase):
             ):
                 self.assertTrue(df[col].equals(result))
 
+    def test_read_filters(self):
+        """ensure filters only return matching rows in every output form"""
+        with TemporaryDirectory() as tmp:
+            parquet_file = os.path.join(tmp, "myfile.parquet")
+            df = pd.DataFrame(
+                {"user": ["u%d" % (i % 7) for i in range(100)], "ts": range(100)}
+            )
+            with atomic_write(parquet_file, as_file=False) as f:
+                df.to_parquet(f, engine="pyarrow", row_group_size=10)
+
+            filters = [("user", "in", ["u1", "u2"]), ("ts", ">=", 50)]
+            expected = df[df.user.isin(["u1", "u2"]) & (df.ts >= 50)]
+
+            result = read_parquet(parquet_file, filters=filters)
+            self.assertEqual(list(result.ts), list(expected.ts))
+            columns = read_parquet_columns(parquet_file, ["ts"], filters=filters)
+            self.assertEqual(list(columns.columns), ["ts"])
+            self.assertEqual(list(columns.ts), list(expected.ts))
+
+            table = read_parquet(parquet_file, ["ts"], filters=filters, output="arrow")
+            self.assertEqual(table.column("ts").to_pylist(), list(expected.ts))
+            batches = read_parquet(
+                parquet_file, ["ts"], filters=filters, output="batches", batch_size=4
+            )
+            self.assertEqual(
+                [ts for batch in batches for ts in batch.column("ts").to_pylist()],
+                list(expected.ts),
+            )
+            self.assertRaises(ValueError, read_parquet, parquet_file, output="csv")
+
+    def test_convert_xlsx_streaming(self):
+        """ensure the streaming conversion matches the in-memory one"""
+        with TemporaryDirectory() as tmp:
+            fp_xlsx = os.path.join(tmp, "myfile.xlsx")
+            df_xlsx = pd.DataFrame(
+                {"a": range(25), "b": ["row %d" % i for i in range(25)]},
+                index=pd.Index(range(100, 125), name="id"),
+            )
+            with atomic_write(fp_xlsx, as_file=False) as f:
+                df_xlsx.to_excel(f)
+
+            expected = pd.read_parquet(convert_excel_to_parquet(fp_xlsx))
+            os.remove(os.path.join(tmp, "myfile.parquet"))
+            parquet_filepath = convert_excel_to_parquet(fp_xlsx, batch_size=7)
+
+            self.assertEqual(os.path.join(tmp, "myfile.parquet"), parquet_filepath)
+            result = pd.read_parquet(parquet_filepath)
+            pd.testing.assert_frame_equal(result, expected)
+            pd.testing.assert_frame_equal(result, df_xlsx)
+
+    def test_convert_xlsx_streaming_widens_types(self):
+        """ensure later batches may fill empty columns and turn ints to floats"""
+        with TemporaryDirectory() as tmp:
+            fp_xlsx = os.path.join(tmp, "myfile.xlsx")
+            df_xlsx = pd.DataFrame(
+                {
+                    "sparse": [None] * 5 + ["x", None, "y"],
+                    "mixed": [1, 2, 3, 4, 4.5, 6, 7, 8],
+                    "late": [None] * 7 + [3],
+                    "empty": [None] * 8,
+                },
+                index=pd.Index(range(8), name="id"),
+            )
+            df_xlsx.to_excel(fp_xlsx)
+
+            expected = pd.read_parquet(convert_excel_to_parquet(fp_xlsx))
+            for batch_size in [2, 3, 100]:
+                out = os.path.join(tmp, "streamed%d.parquet" % batch_size)
+                convert_excel_to_parquet(
+                    fp_xlsx, batch_size=batch_size, parquet_file=out
+                )
+                pd.testing.assert_frame_equal(pd.read_parquet(out), expected)
+            self.assertEqual(sorted(os.listdir(tmp))[0], "myfile.parquet")
+            self.assertEqual(len(os.listdir(tmp)), 5)
+
+    def test_convert_incremental(self):
+        """ensure unchanged sources are skipped and changed ones reconverted"""
+        with TemporaryDirectory() as tmp:
+            fp_xlsx = os.path.join(tmp, "myfile.xlsx")
+            df = pd.DataFrame({"a": [1, 2], "b": ["hello", "world"]})
+            df.to_excel(fp_xlsx)
+
+            for content_hash in [False, True]:
+                parquet_file = convert_excel_to_parquet(
+                    fp_xlsx, incremental=True, content_hash=content_hash
+                )
+                mtime = os.stat(parquet_file).st_mtime_ns
+                # an unchanged source leaves the parquet file alone
+                convert_excel_to_parquet(
+                    fp_xlsx, incremental=True, content_hash=content_hash
+                )
+                self.assertEqual(os.stat(parquet_file).st_mtime_ns, mtime)
+                os.remove(parquet_file)
+
+            # a modified source is converted again
+            convert_excel_to_parquet(fp_xlsx, incremental=True, batch_size=1)
+            (df * 2).to_excel(fp_xlsx)
+            convert_excel_to_parquet(fp_xlsx, incremental=True, batch_size=1)
+            self.assertTrue(pd.read_parquet(parquet_file).equals(df * 2))
+
     def test_convert_xlsx_to_parquet(self):
         """ensure xlsx can be converted to equivalent parquet file"""
         # use temp dir where files will be created for testing purposes
@@ -229,3 +779,718 @@ class ParquetTests(TestCase):
             # ensure contents of xlsx and parquet files match
             df_parquet = pd.read_parquet(fp_parquet, engine="pyarrow")
             self.assertTrue(df_xlsx.equals(df_parquet))
+
+
+class ConvertManyTests(TestCase):
+    def write_workbook(self, fp, sheets):
+        with pd.ExcelWriter(fp) as writer:
+            for name, df in sheets.items():
+                df.to_excel(writer, sheet_name=name)
+
+    def test_convert_many(self):
+        """ensure all workbooks are converted and failures are only reported"""
+        df = pd.DataFrame({"a": [1, 2], "b": ["hello", "world"]})
+        with TemporaryDirectory() as tmp:
+            os.mkdir(os.path.join(tmp, "sub"))
+            self.write_workbook(os.path.join(tmp, "one.xlsx"), {"s": df})
+            self.write_workbook(os.path.join(tmp, "sub", "two.xlsx"), {"s": df * 2})
+            with open(os.path.join(tmp, "bad.xlsx"), "w") as f:
+                f.write("not a workbook")
+
+            results = convert_many(os.path.join(tmp, "**", "*.xlsx"), workers=2)
+
+            errors = {os.path.basename(r.source): r.error for r in results}
+            self.assertEqual(sorted(errors), ["bad.xlsx", "one.xlsx", "two.xlsx"])
+            self.assertIsNotNone(errors["bad.xlsx"])
+            self.assertIsNone(errors["one.xlsx"])
+            two = pd.read_parquet(os.path.join(tmp, "sub", "two.parquet"))
+            self.assertTrue(two.equals(df * 2))
+
+    def test_all_sheets_cli(self):
+        """ensure the cli writes one parquet file per sheet"""
+        df = pd.DataFrame({"a": [1, 2], "b": ["hello", "world"]})
+        with TemporaryDirectory() as tmp:
+            fp = os.path.join(tmp, "book.xlsx")
+            self.write_workbook(fp, {"first": df, "second": df.iloc[:1]})
+            self.assertEqual(
+                cli_main(["convert", fp, "--all-sheets", "--workers", "1"]), 0
+            )
+            second = pd.read_parquet(os.path.join(tmp, "book-second.parquet"))
+            self.assertTrue(second.equals(df.iloc[:1]))
+            self.assertTrue(os.path.exists(os.path.join(tmp, "book-first.parquet")))
+            self.assertEqual(
+                cli_main(["convert", os.path.join(tmp, "missing.xlsx")]), 1
+            )
+
+
+class ParquetReaderCacheTests(TestCase):
+    def test_repeated_reads(self):
+        """ensure cached reads match pandas and reuse decoded columns"""
+        df = pd.DataFrame({"a": range(30), "b": ["x%d" % i for i in range(30)]})
+        df.index = pd.Index(["id%d" % i for i in range(30)], name="id")
+        with TemporaryDirectory() as tmp:
+            fp = os.path.join(tmp, "myfile.parquet")
+            with atomic_write(fp, as_file=False) as f:
+                df.to_parquet(f, engine="pyarrow", row_group_size=10)
+
+            cache = ParquetReaderCache()
+            self.assertTrue(cache.read(fp, ["a"]).equals(df[["a"]]))
+            misses = cache.misses
+            self.assertTrue(cache.read(fp, ["a", "b"]).equals(df))
+            # column a and the index were decoded by the first read already
+            self.assertEqual(cache.misses - misses, 3)
+            self.assertEqual(cache.hits, 6)
+
+            # replacing the file invalidates everything cached for it
+            with atomic_write(fp, as_file=False, overwrite=True) as f:
+                (df * 2).to_parquet(f, engine="pyarrow")
+            self.assertTrue(cache.read(fp, ["a"]).equals(df[["a"]] * 2))
+
+    def test_concurrent_reads(self):
+        """ensure threads evicting each other's handles all read correctly"""
+        with TemporaryDirectory() as tmp:
+            frames = {}
+            for i in range(5):
+                fp = os.path.join(tmp, "c%d.parquet" % i)
+                frames[fp] = pd.DataFrame({"a": range(i, i + 50), "b": ["x"] * 50})
+                frames[fp].to_parquet(fp, row_group_size=10)
+            cache = ParquetReaderCache(max_files=2, max_bytes=4096)
+
+            def read(n):
+                fp = sorted(frames)[n % len(frames)]
+                return fp, cache.read(fp, ["a"])
+
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                for fp, df in pool.map(read, range(400)):
+                    self.assertEqual(list(df.a), list(frames[fp].a))
+            self.assertLessEqual(cache.nbytes, 4096)
+
+    def test_byte_budget(self):
+        """ensure decoded columns are evicted to stay within the budget"""
+        df = pd.DataFrame({"a": range(1000), "b": range(1000)})
+        with TemporaryDirectory() as tmp:
+            fp = os.path.join(tmp, "myfile.parquet")
+            df.to_parquet(fp, engine="pyarrow", index=False)
+            cache = ParquetReaderCache(max_bytes=10000)
+            self.assertTrue(cache.read(fp).equals(df))
+            self.assertLessEqual(cache.nbytes, 10000)
+
+
+class ParquetBatchTests(TestCase):
+    def test_iter_batches(self):
+        """ensure batches cover every matching row of every file, in order"""
+        with TemporaryDirectory() as tmp:
+            paths = []
+            for part in range(3):
+                fp = os.path.join(tmp, "part%d.parquet" % part)
+                df = pd.DataFrame({"n": range(part * 10, part * 10 + 10)})
+                df.to_parquet(fp, engine="pyarrow", index=False)
+                paths.append(fp)
+
+            for readahead in [0, 2]:
+                batches = list(
+                    iter_parquet_batches(
+                        paths,
+                        ["n"],
+                        batch_size=4,
+                        filters=[("n", ">=", 5)],
+                        readahead=readahead,
+                    )
+                )
+                self.assertTrue(all(batch.num_rows <= 4 for batch in batches))
+                rows = [n for batch in batches for n in batch.column("n").to_pylist()]
+                self.assertEqual(rows, list(range(5, 30)))
+
+            frames = iter_parquet_batches(paths[0], as_pandas=True, readahead=1)
+            self.assertIsInstance(next(frames), pd.DataFrame)
+            # stopping early must not leave the readahead thread blocked
+            frames.close()
+
+    def test_readahead_error(self):
+        """ensure errors while reading ahead reach the consumer"""
+
+        def failing():
+            yield 1
+            raise FakeFileFailure()
+
+        items = _readahead(failing(), 2)
+        self.assertEqual(next(items), 1)
+        self.assertRaises(FakeFileFailure, next, items)
+
+
+class ParquetDatasetTests(TestCase):
+    def test_partitioned_dataset(self):
+        """ensure partitions are published whole and pruned by filters"""
+        df = pd.DataFrame(
+            {
+                "day": ["d1", "d1", "d2", "d3"],
+                "user": ["a", "b", "c", "d"],
+                "n": [1, 2, 3, 4],
+            }
+        )
+        with TemporaryDirectory() as tmp:
+            root = os.path.join(tmp, "events")
+            write_parquet_dataset(df, root, partition_cols=["day"])
+            self.assertEqual(os.listdir(tmp), ["events"])
+            self.assertEqual(sorted(os.listdir(root)), ["day=d1", "day=d2", "day=d3"])
+
+            result = read_parquet(root, ["user", "n"], filters=[("day", "==", "d1")])
+            self.assertEqual(list(result.user), ["a", "b"])
+            batches = iter_parquet_batches(
+                root, ["n"], filters=[("day", "in", ["d2", "d3"])]
+            )
+            self.assertEqual(
+                sorted(n for b in batches for n in b.column("n").to_pylist()), [3, 4]
+            )
+
+            # existing datasets are only replaced on request
+            self.assertRaises(FileExistsError, write_parquet_dataset, df, root)
+            frames = [df.iloc[:2], df.iloc[2:]]
+            write_parquet_dataset(
+                iter(frames), root, partition_cols=["day"], overwrite=True
+            )
+            self.assertEqual(len(read_parquet(root)), 4)
+            self.assertEqual(os.listdir(tmp), ["events"])
+
+            # readable like any directory made under the umask, not private
+            os.mkdir(os.path.join(tmp, "plain"))
+            self.assertEqual(
+                os.stat(root).st_mode, os.stat(os.path.join(tmp, "plain")).st_mode
+            )
+
+    def test_failed_write_leaves_nothing(self):
+        """ensure a failing input leaves neither the dataset nor its staging dir"""
+
+        def batches():
+            yield pd.DataFrame({"n": [1]})
+            raise FakeFileFailure()
+
+        with TemporaryDirectory() as tmp:
+            with self.assertRaises(FakeFileFailure):
+                write_parquet_dataset(batches(), os.path.join(tmp, "ds"))
+            self.assertEqual(os.listdir(tmp), [])
+
+
+class ParquetIndexTests(TestCase):
+    def write(self, fp, df):
+        with atomic_write(fp, as_file=False, overwrite=True) as f:
+            df.to_parquet(f, engine="pyarrow", index=False)
+
+    def test_index_prunes_files(self):
+        """ensure files whose statistics rule out a filter are skipped"""
+        with TemporaryDirectory() as tmp:
+            self.write(
+                os.path.join(tmp, "a.parquet"),
+                pd.DataFrame({"n": [1, 2], "s": ["a", "b"]}),
+            )
+            self.write(
+                os.path.join(tmp, "b.parquet"),
+                pd.DataFrame({"n": [5, 9], "s": ["x", "y"]}),
+            )
+            index = build_parquet_index(tmp)
+            self.assertEqual(index.files["a.parquet"]["rows"], 2)
+            self.assertEqual(index.files["b.parquet"]["stats"]["n"], [5, 9])
+
+            b_only = [os.path.join(tmp, "b.parquet")]
+            self.assertEqual(index.candidates([("n", ">", 3)]), b_only)
+            self.assertEqual(index.candidates([("s", "in", ["y", "z"])]), b_only)
+            self.assertEqual(
+                len(index.candidates([[("n", "==", 1)], [("n", "==", 9)]])), 2
+            )
+
+            result = read_parquet(tmp, filters=[("n", ">=", 9)], index=index)
+            self.assertEqual(list(result.n), [9])
+            empty = read_parquet_columns(
+                tmp, ["s"], filters=[("n", ">", 100)], index=index
+            )
+            self.assertEqual((len(empty), list(empty.columns)), (0, ["s"]))
+            batches = iter_parquet_batches(
+                tmp, ["n"], filters=[("n", "<", 2)], index=index
+            )
+            self.assertEqual(
+                [n for b in batches for n in b.column("n").to_pylist()], [1]
+            )
+
+    def test_stale_index_never_drops_rows(self):
+        """ensure files added or rewritten after indexing are still read"""
+        with TemporaryDirectory() as tmp:
+            self.write(os.path.join(tmp, "a.parquet"), pd.DataFrame({"n": [1, 2]}))
+            index = build_parquet_index(tmp)
+            self.write(os.path.join(tmp, "b.parquet"), pd.DataFrame({"n": [50, 60]}))
+
+            gt10 = [("n", ">", 10)]
+            self.assertEqual(sorted(read_parquet(tmp, filters=gt10).n), [50, 60])
+            self.assertEqual(
+                sorted(read_parquet(tmp, filters=gt10, index=index).n), [50, 60]
+            )
+            batches = iter_parquet_batches(tmp, ["n"], filters=gt10, index=index)
+            self.assertEqual(
+                sorted(n for b in batches for n in b.column("n").to_pylist()),
+                [50, 60],
+            )
+
+            # rewritten after indexing, the old statistics rule it out
+            self.write(os.path.join(tmp, "a.parquet"), pd.DataFrame({"n": [70]}))
+            self.assertEqual(
+                sorted(read_parquet(tmp, filters=gt10, index=index).n), [50, 60, 70]
+            )
+
+            # removed after indexing
+            os.remove(os.path.join(tmp, "b.parquet"))
+            self.assertEqual(list(read_parquet(tmp, filters=gt10, index=index).n), [70])
+
+    def test_partitioned_dtypes(self):
+        """ensure reading through the index keeps the partition column types"""
+        with TemporaryDirectory() as tmp:
+            for day, n in [("mon", [1, 2]), ("tue", [30, 40])]:
+                os.mkdir(os.path.join(tmp, "day=" + day))
+                fp = os.path.join(tmp, "day=" + day, "a.parquet")
+                self.write(fp, pd.DataFrame({"n": n}))
+            index = build_parquet_index(tmp)
+
+            for filters in [[("n", ">", 10)], [("n", ">", 100)]]:
+                plain = read_parquet(tmp, filters=filters)
+                indexed = read_parquet(tmp, filters=filters, index=index)
+                self.assertEqual(str(indexed["day"].dtype), "category")
+                pd.testing.assert_frame_equal(
+                    indexed.reset_index(drop=True), plain.reset_index(drop=True)
+                )
+
+    def test_incremental_refresh(self):
+        """ensure only changed files are described again and the index persists"""
+        with TemporaryDirectory() as tmp:
+            fp = os.path.join(tmp, "a.parquet")
+            self.write(fp, pd.DataFrame({"n": [1, 2]}))
+            build_parquet_index(tmp)
+            self.write(fp, pd.DataFrame({"n": [7, 8, 9]}))
+
+            index = ParquetIndex(tmp)
+            self.assertEqual(index.files["a.parquet"]["rows"], 2)
+            index.refresh()
+            self.assertEqual(ParquetIndex(tmp).files["a.parquet"]["stats"]["n"], [7, 9])
+
+
+class ImportTimeTests(TestCase):
+    # generous, a cold start of pandas alone takes longer than this
+    BUDGET_US = 500000
+
+    def test_startup_budget(self):
+        """ensure importing the package stays cheap and skips heavy dependencies"""
+        code = "import csci_utils, csci_utils.hash_str, csci_utils.io, csci_utils.cli"
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+            check=True,
+        )
+        # lines look like "import time: self | cumulative | <indent>package"
+        imported, total = set(), 0
+        for line in proc.stderr.splitlines():
+            fields = line.split("|")
+            if len(fields) != 3 or not fields[1].strip().isdigit():
+                continue
+            name = fields[2].strip()
+            imported.add(name.split(".")[0])
+            # only count top level imports, nested ones are in their cumulative time
+            if name.startswith("csci_utils") and not fields[2].startswith("  "):
+                total += int(fields[1])
+
+        for heavy in ["pandas", "numpy", "pyarrow", "luigi", "setuptools_scm"]:
+            self.assertNotIn(heavy, imported)
+        self.assertLess(total, self.BUDGET_US)
+
+
+class DigestTargetTests(TestCase):
+    def test_digest_recorded_on_commit(self):
+        """ensure the digest of committed contents is recorded and exposed"""
+        with TemporaryDirectory() as tmp:
+            target = DigestLocalTarget(os.path.join(tmp, "out", "data.csv"))
+            self.assertIsNone(target.digest())
+            with target.open("w") as f:
+                f.write("a,b\n1,2\n")
+            expected = hash_str("a,b\n1,2\n").hex()
+            self.assertEqual(target.digest(), expected)
+            self.assertEqual(
+                sorted(os.listdir(os.path.join(tmp, "out"))),
+                [".data.csv.sha256", "data.csv"],
+            )
+
+            # files changed behind the target's back are hashed again
+            with open(target.path, "w") as f:
+                f.write("changed")
+            self.assertEqual(target.digest(), hash_str("changed").hex())
+            target.remove()
+            self.assertEqual(os.listdir(os.path.join(tmp, "out")), [])
+
+    def test_is_current(self):
+        """ensure outputs are current until the bytes of an input change"""
+        with TemporaryDirectory() as tmp:
+            source = DigestLocalTarget(os.path.join(tmp, "in.txt"))
+            with source.open("w") as f:
+                f.write("same")
+            output = DigestLocalTarget(os.path.join(tmp, "out.txt"), inputs=[source])
+            self.assertFalse(output.is_current())
+            with output.temporary_path() as path:
+                with open(path, "w") as f:
+                    f.write("result")
+            self.assertTrue(output.is_current())
+
+            # rewriting identical bytes upstream keeps the output current
+            source.remove()
+            with source.open("w") as f:
+                f.write("same")
+            self.assertTrue(output.is_current())
+            source.remove()
+            with source.open("w") as f:
+                f.write("different")
+            self.assertFalse(output.is_current())
+
+    def test_swapped_inputs(self):
+        """ensure swapping the contents of two inputs makes the output stale"""
+        with TemporaryDirectory() as tmp:
+            a = DigestLocalTarget(os.path.join(tmp, "a.txt"))
+            b = DigestLocalTarget(os.path.join(tmp, "b.txt"))
+            for target, text in [(a, "x"), (b, "y")]:
+                with target.open("w") as f:
+                    f.write(text)
+            output = DigestLocalTarget(os.path.join(tmp, "out.txt"), inputs=[a, b])
+            with output.open("w") as f:
+                f.write("result")
+            self.assertTrue(output.is_current())
+
+            for target, text in [(a, "y"), (b, "x")]:
+                target.remove()
+                with target.open("w") as f:
+                    f.write(text)
+            self.assertFalse(output.is_current())
+
+    def test_relocated_inputs(self):
+        """ensure the same input bytes elsewhere keep the output current"""
+        with TemporaryDirectory() as tmp:
+            inputs = {}
+            for folder in ["old", "new"]:
+                inputs[folder] = [
+                    DigestLocalTarget(os.path.join(tmp, folder, name))
+                    for name in ["a.txt", "b.txt"]
+                ]
+                for target, text in zip(inputs[folder], ["x", "y"]):
+                    with target.open("w") as f:
+                        f.write(text)
+            output = DigestLocalTarget(
+                os.path.join(tmp, "out.txt"), inputs=inputs["old"]
+            )
+            with output.open("w") as f:
+                f.write("result")
+
+            moved = DigestLocalTarget(output.path, inputs=inputs["new"])
+            self.assertTrue(moved.is_current())
+
+
+class ExistenceCheckTests(TestCase):
+    def tearDown(self):
+        disable_existence_cache()
+
+    def test_exists_many(self):
+        """ensure one scan per directory gives the same answer as exists()"""
+        with TemporaryDirectory() as tmp:
+            for name in ["a.csv", "sub/b.csv"]:
+                os.makedirs(os.path.dirname(os.path.join(tmp, name)), exist_ok=True)
+                open(os.path.join(tmp, name), "w").close()
+            os.symlink(os.path.join(tmp, "gone"), os.path.join(tmp, "broken"))
+            names = ["a.csv", "sub/b.csv", "c.csv", "sub", "broken", "missing/d.csv"]
+            targets = [SuffixPreservingLocalTarget(os.path.join(tmp, n)) for n in names]
+            expected = [t.exists() for t in targets]
+            self.assertEqual(expected, [True, True, False, True, False, False])
+            self.assertEqual(exists_many(targets), expected)
+            self.assertEqual(exists_many([t.path for t in targets]), expected)
+
+    def test_cache_updated_by_commits(self):
+        """ensure cached results never hide what this process just wrote"""
+        enable_existence_cache(ttl=60)
+        with TemporaryDirectory() as tmp:
+            target = SuffixPreservingLocalTarget(os.path.join(tmp, "out.txt"))
+            self.assertEqual(exists_many([target]), [False])
+
+            # written behind the cache's back, still reported missing
+            open(target.path, "w").close()
+            self.assertFalse(target.exists())
+            os.remove(target.path)
+
+            with target.open("w") as f:
+                f.write("done")
+            self.assertTrue(target.exists())
+            self.assertEqual(exists_many([target]), [True])
+            target.remove()
+            self.assertFalse(target.exists())
+
+    def test_cache_updated_by_base_target(self):
+        """ensure targets using the default atomic provider update the cache"""
+        enable_existence_cache(ttl=60)
+        with TemporaryDirectory() as tmp:
+            target = BaseAtomicProviderLocalTarget(os.path.join(tmp, "out.txt"))
+            self.assertFalse(target.exists())
+            with target.open("w") as f:
+                f.write("done")
+            self.assertTrue(target.exists())
+
+            other = BaseAtomicProviderLocalTarget(os.path.join(tmp, "other.txt"))
+            self.assertFalse(other.exists())
+            with other.temporary_path() as path:
+                with open(path, "w") as f:
+                    f.write("done")
+            self.assertTrue(other.exists())
+
+    def test_cache_updated_by_move_and_copy(self):
+        """ensure moved and copied targets are not reported missing"""
+        enable_existence_cache(ttl=60)
+        with TemporaryDirectory() as tmp:
+            a = SuffixPreservingLocalTarget(os.path.join(tmp, "a.txt"))
+            b = SuffixPreservingLocalTarget(os.path.join(tmp, "b.txt"))
+            c = SuffixPreservingLocalTarget(os.path.join(tmp, "c.txt"))
+            self.assertEqual([b.exists(), c.exists()], [False, False])
+            with a.open("w") as f:
+                f.write("done")
+
+            a.move(b.path)
+            self.assertEqual([a.exists(), b.exists()], [False, True])
+            b.copy(c.path)
+            self.assertEqual([b.exists(), c.exists()], [True, True])
+
+    def test_cache_expires(self):
+        """ensure entries are checked on disk again after the ttl"""
+        enable_existence_cache(ttl=0)
+        with TemporaryDirectory() as tmp:
+            target = SuffixPreservingLocalTarget(os.path.join(tmp, "out.txt"))
+            self.assertFalse(target.exists())
+            open(target.path, "w").close()
+            self.assertTrue(target.exists())
+
+
+class CompressedFormatTests(TestCase):
+    def test_tmp_path_keeps_compound_suffix(self):
+        """ensure temp files keep every suffix of the final name"""
+        tmp = suffix_preserving_atomic_file.generate_tmp_path(None, "a.b/data.csv.zst")
+        self.assertEqual(os.path.dirname(tmp), "a.b")
+        self.assertTrue(os.path.basename(tmp).startswith("data-luigi-tmp-"))
+        self.assertTrue(tmp.endswith(".csv.zst"))
+
+    def roundtrip(self, fmt, name, ratio=3):
+        data = b"".join(b"%d,user%d\n" % (i, i % 97) for i in range(50000))
+        with TemporaryDirectory() as tmp:
+            target = SuffixPreservingLocalTarget(os.path.join(tmp, name), format=fmt)
+            with target.open("w") as f:
+                f.write(data[:1000])
+                f.write(data[1000:])
+            self.assertEqual(os.listdir(tmp), [name])
+            self.assertLess(os.path.getsize(target.path), len(data) / ratio)
+            with target.open("r") as f:
+                self.assertEqual(f.read(), data)
+
+    def test_gzip(self):
+        """ensure parallel gzip blocks read back through the target"""
+        self.roundtrip(GzipFormat(threads=4, buffer_size=1 << 16), "x.csv.gz")
+
+    def test_gzip_standard_reader(self):
+        """ensure the concatenated members form a standard gzip file"""
+        with TemporaryDirectory() as tmp:
+            fmt = GzipFormat(threads=4, buffer_size=1 << 12)
+            target = SuffixPreservingLocalTarget(
+                os.path.join(tmp, "x.csv.gz"), format=fmt
+            )
+            with target.open("w") as f:
+                f.write(b"abc" * 10000)
+            with gzip.open(target.path) as f:
+                self.assertEqual(f.read(), b"abc" * 10000)
+
+            # empty outputs are valid too
+            with target.open("w") as f:
+                pass
+            with gzip.open(target.path) as f:
+                self.assertEqual(f.read(), b"")
+
+    def test_text_chain(self):
+        """ensure text formats chain in front of the compression"""
+        from luigi.format import UTF8
+
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "x.jsonl.gz")
+            target = SuffixPreservingLocalTarget(path, format=UTF8 >> GzipFormat())
+            with target.open("w") as f:
+                f.write("naïve\n")
+            with target.open("r") as f:
+                self.assertEqual(f.read(), "naïve\n")
+
+    def test_abort_on_error(self):
+        """ensure an exception inside the with block commits nothing"""
+        with TemporaryDirectory() as tmp:
+            fmt = GzipFormat(threads=2)
+            target = SuffixPreservingLocalTarget(os.path.join(tmp, "x.gz"), format=fmt)
+            with self.assertRaises(FakeFileFailure):
+                with target.open("w") as f:
+                    f.write(b"partial")
+                    raise FakeFileFailure()
+            del f
+            self.assertFalse(target.exists())
+            self.assertEqual(os.listdir(tmp), [])
+
+    @skipUnless(importlib.util.find_spec("zstandard"), "zstandard not installed")
+    def test_zstd(self):
+        self.roundtrip(ZstdFormat(threads=4, buffer_size=1 << 16), "x.csv.zst")
+
+    @skipUnless(importlib.util.find_spec("lz4"), "lz4 not installed")
+    def test_lz4(self):
+        # lz4 trades compression ratio for speed, about 2x on this data
+        self.roundtrip(Lz4Format(threads=4, buffer_size=1 << 16), "x.csv.lz4", 1.5)
+
+
+class HashCliTests(TestCase):
+    def test_csv_and_parquet(self):
+        """ensure the hash command matches get_user_id chunk after chunk"""
+        df = pd.DataFrame(
+            {
+                "user": ["Ann%d" % (i % 7) for i in range(25)],
+                "n": [str(i) for i in range(25)],
+            }
+        )
+        with set_env(CSCI_SALT="1234"), TemporaryDirectory() as tmp:
+            src = os.path.join(tmp, "in.csv")
+            df.to_csv(src, index=False)
+            for workers in ["1", "2"]:
+                out = os.path.join(tmp, "out%s.parquet" % workers)
+                args = ["hash", "--column", "user", "--in", src, "--out", out]
+                self.assertEqual(
+                    cli_main(args + ["--workers", workers, "--chunk-size", "10"]), 0
+                )
+                hashed = pd.read_parquet(out)
+                self.assertEqual(
+                    hashed["user"].tolist(), [get_user_id(u) for u in df["user"]]
+                )
+                self.assertEqual(hashed["n"].tolist(), df["n"].tolist())
+
+            # and back to csv from the parquet output, other columns untouched
+            back = os.path.join(tmp, "back.csv")
+            args = [
+                "hash",
+                "--column",
+                "n",
+                "--in",
+                out,
+                "--out",
+                back,
+                "--workers",
+                "1",
+            ]
+            self.assertEqual(cli_main(args), 0)
+            again = pd.read_csv(back, dtype=str)
+            self.assertEqual(again["n"].tolist(), [get_user_id(n) for n in df["n"]])
+            self.assertEqual(again["user"].tolist(), hashed["user"].tolist())
+
+    def test_missing_values(self):
+        """ensure missing users stay missing from csv and parquet inputs alike"""
+        df = pd.DataFrame({"user": ["Ann", None, "Bob"], "n": ["1", "2", "3"]})
+        with set_env(CSCI_SALT="1234"), TemporaryDirectory() as tmp:
+            expected = [get_user_id("Ann"), get_user_id("Bob")]
+            sources = [os.path.join(tmp, "in.csv"), os.path.join(tmp, "in.parquet")]
+            df.to_csv(sources[0], index=False)
+            df.to_parquet(sources[1])
+            for src in sources:
+                out = src + ".out.csv"
+                args = ["hash", "--column", "user", "--in", src, "--out", out]
+                self.assertEqual(cli_main(args + ["--workers", "1"]), 0)
+                hashed = pd.read_csv(out, dtype=str)["user"]
+                self.assertEqual(hashed.isna().tolist(), [False, True, False])
+                self.assertEqual(hashed.dropna().tolist(), expected)
+
+    def test_existing_output(self):
+        """ensure an existing output is only replaced with --overwrite"""
+        with set_env(CSCI_SALT="1234"), TemporaryDirectory() as tmp:
+            src = os.path.join(tmp, "in.csv")
+            pd.DataFrame({"user": ["Ann"]}).to_csv(src, index=False)
+            out = os.path.join(tmp, "out.csv")
+            with open(out, "w") as f:
+                f.write("old")
+            args = ["hash", "--column", "user", "--in", src, "--out", out]
+            self.assertEqual(cli_main(args + ["--workers", "1"]), 1)
+            with open(out) as f:
+                self.assertEqual(f.read(), "old")
+
+            self.assertEqual(cli_main(args + ["--workers", "1", "--overwrite"]), 0)
+            hashed = pd.read_csv(out, dtype=str)
+            self.assertEqual(hashed["user"].tolist(), [get_user_id("Ann")])
+
+    def test_missing_column(self):
+        """ensure nothing is written when the column does not exist"""
+        with set_env(CSCI_SALT="1234"), TemporaryDirectory() as tmp:
+            src = os.path.join(tmp, "in.csv")
+            pd.DataFrame({"a": ["x"]}).to_csv(src, index=False)
+            out = os.path.join(tmp, "out.csv")
+            args = ["hash", "--column", "user", "--in", src, "--out", out]
+            self.assertEqual(cli_main(args + ["--workers", "1"]), 1)
+            self.assertFalse(os.path.exists(out))
+
+
+class InstrumentTests(TestCase):
+    def test_disabled(self):
+        """ensure nothing is measured without a sink"""
+        self.assertIs(instrument.timer("a"), instrument.timer("b"))
+        items = [1, 2]
+        self.assertIs(instrument.timed(items, "a"), items)
+
+    def test_atomic_write_and_hash_phases(self):
+        """ensure every phase is reported once with the bytes involved"""
+        with TemporaryDirectory() as tmp:
+            with instrument.collect() as summary:
+                with atomic_write(os.path.join(tmp, "f.txt"), mode="wb") as f:
+                    f.write(b"x" * 1000)
+                hash_str("abc")
+                hash_file(os.path.join(tmp, "f.txt"))
+            with atomic_write(os.path.join(tmp, "g.txt")) as f:
+                f.write("not recorded")
+
+        stats = summary.snapshot()
+        self.assertEqual(
+            sorted(stats),
+            [
+                "atomic_write.commit",
+                "atomic_write.open",
+                "atomic_write.sync",
+                "atomic_write.write",
+                "hash_file",
+                "hash_str",
+            ],
+        )
+        self.assertTrue(all(s.count == 1 for s in stats.values()))
+        self.assertEqual(stats["atomic_write.write"].nbytes, 1000)
+        self.assertEqual(stats["hash_file"].nbytes, 1000)
+        self.assertEqual(stats["hash_str"].nbytes, 3)
+
+        text = summary.prometheus()
+        self.assertIn("# TYPE csci_utils_phase_calls_total counter", text)
+        self.assertIn('csci_utils_phase_bytes_total{phase="hash_file"} 1000', text)
+
+    def test_convert_phases(self):
+        """ensure conversions report parse and encode, per batch when streaming"""
+        df = pd.DataFrame({"a": range(5)})
+        with TemporaryDirectory() as tmp:
+            fp = os.path.join(tmp, "book.xlsx")
+            df.to_excel(fp)
+            with instrument.collect() as summary:
+                convert_excel_to_parquet(fp)
+                convert_excel_to_parquet(
+                    fp, batch_size=2, parquet_file=os.path.join(tmp, "s.parquet")
+                )
+        stats = summary.snapshot()
+        self.assertEqual(stats["convert.parse"].count, 1 + 3)
+        self.assertEqual(stats["convert.encode"].count, 1 + 3)
+        self.assertEqual(stats["atomic_write.commit"].count, 2)
+
+    def test_logging_sink(self):
+        """ensure events can be sent to python logging"""
+        sink = instrument.add_sink(instrument.LoggingSink())
+        try:
+            with self.assertLogs("csci_utils.instrument", "DEBUG") as logs:
+                hash_str("abcd")
+        finally:
+            instrument.remove_sink(sink)
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn("hash_str took", logs.output[0])